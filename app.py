@@ -1,13 +1,18 @@
 import streamlit as st
-from datetime import datetime
+import os
+import time
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 import random
 
-from utils import simulate_gates, simulate_gates_over_time, objective, optimize_gate_openings, hybrid_loss_fn, smart_optimize_gates
-from plot import plot_gates
+# Only what both pages need is imported here; AI Mode imports its extras
+# (jobs, mpc, pandas) itself. Budget: check_imports.py
+from cache import cached_simulate_gates, cached_smart_optimize_gates, cached_forecast_final_state, simulation_cache, simulator_cache, gate_image_cache, solution_store, result_store
+from plot import GatePlotRenderer, display_key
+import profiling
+
+# Offline response surface for AI Mode, built by `python surrogate.py`. Opt-in
+# (GATE_SURROGATE=surrogate.npz): a plain optimize is as accurate and faster
+SURROGATE_PATH = os.environ.get("GATE_SURROGATE") or None
 
 st.set_page_config(page_title="Smart Water Manager", layout="wide")
 # Initialize state only once
@@ -17,12 +22,57 @@ if "gates" not in st.session_state:
 if "gate_levels" not in st.session_state:
     st.session_state.gate_levels = {gate: 0.2 for gate in st.session_state.gates}
 
+# One gate diagram per session, redrawn in place on every rerun
+if "gate_plot" not in st.session_state:
+    st.session_state.gate_plot = GatePlotRenderer()
+
+def gate_diagram_png(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12):
+    # Flipping back to a state someone already looked at is served from the shared PNG cache
+    key = display_key(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=current_levels, y_min=y_min, y_max=y_max)
+    png = gate_image_cache.get(key)
+    if png is None:
+        png = st.session_state.gate_plot.render_png(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=current_levels, y_min=y_min, y_max=y_max)
+        gate_image_cache.put(key, png)
+    return png
+
+@st.fragment(run_every=1)
+def optimize_job_panel():
+    # Polls this session's background optimization without rerunning the page
+    from jobs import job_runner, QUEUED, RUNNING, DONE, FAILED
+    job_id = st.session_state.get("optimize_job")
+    job = job_runner.status(job_id) if job_id else None
+    if job is None:
+        st.session_state.pop("optimize_job", None)
+        st.rerun(scope="app")
+    if job["state"] in (QUEUED, RUNNING):
+        st.caption(f"กำลังปรับ... รอบที่ {job['iterations']}" + ("" if job["best_fun"] is None else f", loss {job['best_fun']:.4g}"))
+        if st.button("ยกเลิก"):
+            job_runner.cancel(job_id)
+        return
+    del st.session_state.optimize_job
+    if job["state"] == DONE:
+        best_h, loss, _ = job["result"]
+        inflow_used, q_target_used, initial_ys_used = st.session_state.optimize_job_inputs
+        st.session_state.last_optimum = best_h
+        solution_store.add(inflow_used, q_target_used, initial_ys_used, best_h)
+        for gate, level in zip(st.session_state.gates, best_h.tolist()):
+            st.session_state.gate_levels[gate] = level
+        if job["metrics"] is not None:
+            st.session_state.last_optimize_metrics = dict(job["metrics"], total_s=job["elapsed_s"])
+    elif job["state"] == FAILED:
+        st.session_state.optimize_job_error = job["error"]
+    st.rerun(scope="app")
+
 # Sidebar: User Inputs
 # st.sidebar.title("เลือกประตูระบายน้ำ")
 # Sidebar navigation
 st.sidebar.title("📂 Navigation")
 page = st.sidebar.radio("Go to", ["โหมดทดลอง (What-If)", "โหมดอัตโนมัติ (AI Mode)"])
 st.sidebar.markdown("---")
+# Debug panel: collect solver metrics for this rerun only when asked to
+debug = st.sidebar.checkbox("🐞 Debug")
+profiling.activate(profiling.Metrics() if debug else None)
+run_started = time.perf_counter()
 # Generate time options: "00:00", "01:00", ..., "23:00"
 
 # Set seed for reproducibility
@@ -152,12 +202,12 @@ if page == "โหมดทดลอง (What-If)":
         dt = 10
         initial_ys=list(st.session_state.water_levels.values())
         current_levels = initial_ys
-        qs, water_levels = simulate_gates_over_time(inflow, gate_levels, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=prediction_interval*3600//dt)
-        water_levels = np.concatenate([[max_w_height], water_levels[-1]])
-        qs=np.concatenate([[inflow], qs[-1,1:]])
+        q_last, y_last = cached_forecast_final_state(inflow, gate_levels, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=prediction_interval*3600//dt)
+        water_levels = np.concatenate([[max_w_height], y_last])
+        qs=np.concatenate([[inflow], q_last[1:]])
     else:
         current_levels = list(st.session_state.water_levels.values())
-        qs, _ = simulate_gates(inflow, gate_levels, initial_y0=max_w_height, Cds=Cds)
+        qs, _ = cached_simulate_gates(inflow, gate_levels, initial_y0=max_w_height, Cds=Cds)
         water_levels = [max_w_height]+list(st.session_state.water_levels.values())
     # print(water_levels)
     gate_names = ["C2", "Boromthat", "Chanasut", "Bangrajan", "Yangmani", "Pak-hai"]
@@ -166,8 +216,7 @@ if page == "โหมดทดลอง (What-If)":
 
     
 
-    fig = plot_gates(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height, current_levels=current_levels)
-    st.session_state.fig = fig
+    png = gate_diagram_png(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height, current_levels=current_levels)
     # fig = animate_water_levels(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height)
     # Generate and display
 
@@ -175,12 +224,14 @@ if page == "โหมดทดลอง (What-If)":
     # 4️⃣ Fill the top placeholder with the plot
     with plot_placeholder:
         st.markdown("### 🧭 ภาพจำลองประตู")
-        st.pyplot(fig)
+        st.image(png, use_container_width=True)
         # gif_path = animate_ripple_color(gate_names, gate_heights, gate_positions, water_levels, qs, "water.gif")
         # st.image(gif_path)
 
 
 elif page == "โหมดอัตโนมัติ (AI Mode)":  
+    from jobs import job_runner
+    from mpc import mpc_control
 
     # Main Panel
     # st.title("📊 ระบบแดชบอร์ดบริหารจัดการน้ำอัจฉริยะ")
@@ -239,40 +290,63 @@ elif page == "โหมดอัตโนมัติ (AI Mode)":
                 disabled=True
         )
     with col2:
-        if prediction_interval and st.button("ปรับอัตโนมัติ"):
+        optimize_job = st.session_state.get("optimize_job")
+        if prediction_interval and st.button("ปรับอัตโนมัติ", disabled=optimize_job is not None):
             dt = 10
             # Example usage:
-            best_h, loss, (q_vals, y_vals) = smart_optimize_gates(q0=inflow, q_target=q_target, Cds=Cds, initial_ys=list(st.session_state.water_levels.values()), y_min=min_w_height, y_max=max_w_height, y_target=ys, dt=dt, steps=prediction_interval*3600//dt)
-            qs=np.concatenate([[inflow], q_vals[-1,1:]])
-            water_levels = np.concatenate([[max_w_height], y_vals[-1]])
-            # water_levels = y_vals[-1]
-            gate_heights = [100] + best_h.tolist()
-            for i in range(len(st.session_state.gates)):
-                gate = st.session_state.gates[i]
-                st.session_state.gate_levels[gate] = gate_heights[i+1]
-    
+            initial_ys = list(st.session_state.water_levels.values())
+            # Warm start: this session's last optimum, else the nearest one any session found
+            warm_start = st.session_state.get("last_optimum")
+            if warm_start is None:
+                warm_start = solution_store.nearest(inflow, q_target, initial_ys)
+            # Runs in the background; optimize_job_panel below polls it
+            st.session_state.optimize_job = job_runner.submit(cached_smart_optimize_gates, collect_metrics=debug, q0=inflow, q_target=q_target, Cds=Cds, initial_ys=initial_ys, y_min=min_w_height, y_max=max_w_height, y_target=ys, dt=dt, steps=prediction_interval*3600//dt, surrogate=SURROGATE_PATH, initial_guess=warm_start)
+            st.session_state.optimize_job_inputs = (inflow, q_target, initial_ys)
             st.rerun()
-            # 4️⃣ Fill the top placeholder with the plot
-            with plot_placeholder:
-                fig = plot_gates(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height)
-                st.markdown("### 🧭 ภาพจำลองประตู")
-                st.pyplot(fig)
-        elif prediction_interval:
+        if optimize_job is not None:
+            optimize_job_panel()
+        if "optimize_job_error" in st.session_state:
+            st.error(st.session_state.pop("optimize_job_error"))
+        if prediction_interval:
             dt = 10
             initial_ys=list(st.session_state.water_levels.values())
             current_levels = initial_ys
-            qs, water_levels = simulate_gates_over_time(inflow, gate_levels, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=prediction_interval*3600//dt)
-            water_levels = np.concatenate([[max_w_height], water_levels[-1]])
-            qs=np.concatenate([[inflow], qs[-1,1:]])
+            q_last, y_last = cached_forecast_final_state(inflow, gate_levels, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=prediction_interval*3600//dt)
+            water_levels = np.concatenate([[max_w_height], y_last])
+            qs=np.concatenate([[inflow], q_last[1:]])
             gate_names = ["C2", "Boromthat", "Chanasut", "Bangrajan", "Yangmani", "Pak-hai"]
             gate_heights = [0] + gate_levels
             gate_positions = [i for i in range(len(st.session_state.gates)+1)]
            
         else:
-            qs, _ = simulate_gates(inflow, gate_levels, initial_y0=max_w_height, Cds=Cds)
+            qs, _ = cached_simulate_gates(inflow, gate_levels, initial_y0=max_w_height, Cds=Cds)
             water_levels = [max_w_height]+list(st.session_state.water_levels.values())
         with plot_placeholder:
-            fig = plot_gates(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height, current_levels=current_levels)
-            st.pyplot(fig)
-    
+            png = gate_diagram_png(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=min_w_height, y_max=max_w_height, current_levels=current_levels)
+            st.image(png, use_container_width=True)
+
+    # Closed-loop control for the next 24 hours of the hourly inflow profile
+    st.markdown("#### ควบคุมล่วงหน้า 24 ชั่วโมง (MPC)")
+    if st.button("คำนวณแผน MPC"):
+        start = time_options.index(selected_time)
+        profile = [inflows[time_options[(start + k) % 24]] for k in range(24)]
+        st.session_state.mpc_result = mpc_control(profile, initial_ys=list(st.session_state.water_levels.values()), q_target=q_target, y_min=min_w_height, y_max=max_w_height, h0=gate_levels, Cds=Cds)
+        st.session_state.mpc_start = start
+    if "mpc_result" in st.session_state:
+        result = st.session_state.mpc_result
+        hours = [time_options[(st.session_state.mpc_start + k) % 24] for k in range(len(result.openings))]
+        import pandas as pd
+        st.line_chart(pd.DataFrame(result.openings, index=hours, columns=st.session_state.gates))
+        st.caption(f"solve time {result.solve_times.sum():.2f} s, {int(result.iterations.sum())} iterations")
+
 
+if debug:
+    from jobs import job_runner
+    with st.sidebar.expander("🐞 Debug", expanded=True):
+        st.markdown("**รอบนี้ (this rerun)**")
+        st.json(dict(profiling.current().summary(), total_s=time.perf_counter() - run_started))
+        if "last_optimize_metrics" in st.session_state:
+            st.markdown("**ปรับอัตโนมัติ ครั้งล่าสุด (last optimize click)**")
+            st.json(st.session_state.last_optimize_metrics)
+        st.markdown("**Cache**")
+        st.json({"simulation": simulation_cache.stats(), "simulator": simulator_cache.stats(), "gate_images": gate_image_cache.stats(), "solutions": solution_store.stats(), "jobs": job_runner.stats(), "disk": None if result_store is None else result_store.stats()})
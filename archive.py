@@ -0,0 +1,167 @@
+"""Memory-mapped trajectory archives for long-horizon runs.
+
+    simulate_to_archive("week.traj", q0=120, h=[0.5] * 5, dt=1, steps=7 * 86400)
+    archive = open_archive("week.traj")
+    archive.ys[::3600, 0]      # hourly level of gate 1, read from disk on demand
+
+An archive is a directory with qs.npy (steps, n_gates+1) and ys.npy
+(steps+1, n_gates) in simulate_gates_over_time layout, plus header.json
+describing dt, the gates and the inputs. The trajectory is simulated in
+float64 chunks, carrying the solver state from one chunk to the next, and
+each chunk is copied straight into the memory-mapped .npy files; memory
+use depends on chunk_steps, not the horizon, and the numbers equal
+simulate_gates_over_time's up to the storage dtype (float32 halves the
+files). open_archive maps the files read-only without copying; an archive
+that is still being written shows the steps finished so far.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+from store import MODEL_VERSION
+from utils import _integrate, _step_coefficients, inflow_on_grid, schedule_on_grid
+
+FORMAT_VERSION = 1
+DTYPES = ("float32", "float64")
+HEADER = "header.json"
+# Input arrays longer than this go to their own .npy instead of the header
+INLINE_VALUES = 4096
+
+
+def _write_header(path, header):
+    # Replace atomically so a reader never sees a half-written header
+    tmp = os.path.join(path, HEADER + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=1)
+    os.replace(tmp, os.path.join(path, HEADER))
+
+
+def _input(path, name, value):
+    if value is None:
+        return None
+    value = np.asarray(value, dtype=float)
+    if value.size <= INLINE_VALUES:
+        return value.tolist()
+    np.save(os.path.join(path, f"input_{name}.npy"), value)
+    return {"file": f"input_{name}.npy", "shape": list(value.shape)}
+
+
+def simulate_to_archive(path, q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360,
+                        backend="auto", q0_times=None, h_times=None, dtype="float32", chunk_steps=3600):
+    """Run simulate_gates_over_time(...) into an archive at ``path``; returns open_archive(path).
+
+    Takes simulate_gates_over_time's arguments: q0 may be an inflow series
+    and h a (k, n_gates) gate schedule. ``dtype`` is the storage type of the
+    trajectory, ``chunk_steps`` the steps simulated per chunk.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, got {dtype!r}")
+    q0 = np.asarray(q0, dtype=float)
+    h = np.asarray(h, dtype=float)
+    n_gates = h.shape[-1]
+    if q0.ndim and q0_times is None and q0.shape[-1] != steps:
+        raise ValueError(f"inflow series has {q0.shape[-1]} values for {steps} steps; pass q0_times")
+    if h.ndim == 2 and h_times is None and h.shape[0] != steps:
+        raise ValueError(f"gate schedule has {h.shape[0]} rows for {steps} steps; pass h_times")
+
+    os.makedirs(path, exist_ok=True)
+    header = {
+        "format": FORMAT_VERSION,
+        "model_version": MODEL_VERSION,
+        "dt": dt,
+        "steps": steps,
+        "steps_done": 0,
+        "complete": False,
+        "n_gates": n_gates,
+        "dtype": dtype,
+        "created": time.time(),
+        "inputs": {
+            "q0": _input(path, "q0", q0), "q0_times": _input(path, "q0_times", q0_times),
+            "h": _input(path, "h", h), "h_times": _input(path, "h_times", h_times),
+            "initial_ys": _input(path, "initial_ys", initial_ys), "Cds": _input(path, "Cds", Cds),
+            "gate_width": _input(path, "gate_width", gate_width), "length": length,
+        },
+    }
+    _write_header(path, header)
+    qs_file = np.lib.format.open_memmap(os.path.join(path, "qs.npy"), mode="w+", dtype=dtype, shape=(steps, n_gates + 1))
+    ys_file = np.lib.format.open_memmap(os.path.join(path, "ys.npy"), mode="w+", dtype=dtype, shape=(steps + 1, n_gates))
+
+    current_ys = np.broadcast_to(np.asarray(initial_ys, dtype=float), (1, n_gates)).copy()
+    current_q0 = q0[None] if q0.ndim == 0 else q0[:1]
+    ys_prev = None
+    ys_file[0] = current_ys[0]
+    chunk = max(1, min(chunk_steps, steps))
+    qs_buffer, ys_buffer = np.empty((1, chunk, n_gates + 1)), np.empty((1, chunk + 1, n_gates))
+    coef = _step_coefficients(h, Cds, gate_width)[None] if h.ndim == 1 else None
+
+    for start in range(0, steps, chunk):
+        n = min(chunk, steps - start)
+        if h.ndim == 2:
+            schedule = h[start:start + n] if h_times is None else schedule_on_grid(h, dt, n, h_times, start=start)
+            coef = _step_coefficients(schedule, Cds, gate_width)[None]
+        inflow = None
+        if q0.ndim:
+            inflow = (q0[start:start + n] if q0_times is None else inflow_on_grid(q0, dt, n, q0_times, start=start))[None]
+        qs, ys = _integrate(coef, current_ys, current_q0, dt, n, ys_prev=ys_prev, backend=backend, inflow=inflow,
+                            out=(qs_buffer[:, :n], ys_buffer[:, :n + 1]))
+        qs_file[start:start + n] = qs[0]
+        ys_file[start + 1:start + n + 1] = ys[0, 1:]
+        # State the next chunk resumes from, as GateSimulator.advance keeps it
+        ys_prev, current_ys, current_q0 = ys[:, -2].copy(), ys[:, -1].copy(), qs[:, -1, -1].copy()
+        header["steps_done"] = start + n
+        _write_header(path, header)
+
+    qs_file.flush()
+    ys_file.flush()
+    del qs_file, ys_file
+    header["complete"] = True
+    _write_header(path, header)
+    return open_archive(path)
+
+
+class Archive:
+    """Read-only, memory-mapped view of an archive written by simulate_to_archive."""
+
+    def __init__(self, path, header, qs, ys):
+        self.path = path
+        self.header = header
+        self.qs = qs
+        self.ys = ys
+
+    @property
+    def dt(self):
+        return self.header["dt"]
+
+    @property
+    def steps(self):
+        # Steps available, fewer than header["steps"] while still being written
+        return len(self.qs)
+
+    @property
+    def complete(self):
+        return self.header["complete"]
+
+    def times(self):
+        """Seconds of every ys row (qs row t ends at times()[t + 1])."""
+        return self.dt * np.arange(self.steps + 1)
+
+    def input(self, name):
+        """One of the inputs in the header, e.g. "q0" or "h", as an array."""
+        value = self.header["inputs"][name]
+        if isinstance(value, dict):
+            return np.load(os.path.join(self.path, value["file"]), mmap_mode="r")
+        return None if value is None else np.asarray(value)
+
+
+def open_archive(path):
+    """Map an archive's trajectory without reading it into memory."""
+    with open(os.path.join(path, HEADER), encoding="utf-8") as f:
+        header = json.load(f)
+    if header.get("format") != FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported archive format {header.get('format')!r}")
+    done = header["steps_done"]
+    qs = np.load(os.path.join(path, "qs.npy"), mmap_mode="r")
+    ys = np.load(os.path.join(path, "ys.npy"), mmap_mode="r")
+    return Archive(path, header, qs[:done], ys[:done + 1])
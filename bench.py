@@ -0,0 +1,191 @@
+"""Benchmarks for the simulator and optimizer hot paths.
+
+    python bench.py --out bench.json
+    python bench.py --quick --compare bench.json
+
+Every case records wall time (min/median over --repeat runs) together with
+the work profiling.collect() saw in one extra instrumented run: nonlinear
+solves (one per implicit step), Newton iterations, and loss evaluations
+for the optimizer cases, so results from different commits can be
+compared with --compare.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import numpy as np
+import scipy
+
+import kernels
+import profiling
+import utils
+
+HORIZONS_H = [1, 6, 24, 72]
+DTS = [1, 10, 60]
+GATE_COUNTS = [5, 10, 20, 50]
+OPTIMIZER_HORIZONS_H = [1, 6, 24]
+
+
+def scenario(n_gates, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "q0": float(rng.uniform(100, 140)),
+        "h": rng.uniform(0.1, 2.0, n_gates).tolist(),
+        "initial_ys": np.sort(rng.uniform(6, 12, n_gates))[::-1].tolist(),
+        "Cds": [0.5] * n_gates,
+    }
+
+
+def run_case(name, params, fn, repeat):
+    # Work counters come from the first run; timing uses uninstrumented runs
+    with profiling.collect() as metrics:
+        extra = fn() or {}
+    counters = metrics.counters
+    work = {
+        "solves": counters.get("nonlinear_solves", 0),
+        "newton_iterations": counters.get("residual_evaluations", 0),
+        "nfev": counters.get("loss_evaluations", 0),
+        **extra,
+    }
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {
+        "name": name,
+        "params": params,
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        **work,
+    }
+    print(f"{name:28s} {json.dumps(params):60s} min={result['min'] * 1e3:10.2f} ms  solves={work['solves']}")
+    return result
+
+
+def bench_simulate_gates(repeat, number=1000):
+    s = scenario(5)
+
+    def fn():
+        for _ in range(number):
+            utils.simulate_gates(s["q0"], s["h"], Cds=s["Cds"])
+
+    return [run_case("simulate_gates", {"number": number}, fn, repeat)]
+
+
+def bench_simulate_gates_over_time(horizons, dts, gate_counts, repeat, backend="auto"):
+    results = []
+    for n_gates in gate_counts:
+        s = scenario(n_gates)
+        for hours in horizons:
+            for dt in dts:
+                steps = hours * 3600 // dt
+                params = {"hours": hours, "dt": dt, "gates": n_gates, "steps": steps, "backend": kernels.resolve_backend(backend)}
+
+                def fn():
+                    utils.simulate_gates_over_time(s["q0"], s["h"], initial_ys=s["initial_ys"], Cds=s["Cds"], dt=dt, steps=steps, backend=backend)
+
+                results.append(run_case("simulate_gates_over_time", params, fn, repeat))
+    return results
+
+
+def bench_hybrid_loss(horizons, repeat, dt=10):
+    results = []
+    s = scenario(5)
+    for hours in horizons:
+        steps = hours * 3600 // dt
+        args = (s["q0"], 12.0, 12.0, None, s["initial_ys"], 6, 12, s["Cds"], dt, steps)
+        params = {"hours": hours, "dt": dt, "gates": 5, "steps": steps}
+        results.append(run_case("hybrid_loss_fn", params, lambda: {"loss": float(utils.hybrid_loss_fn(s["h"], *args))}, repeat))
+        results.append(run_case("hybrid_loss_and_grad", params, lambda: {"loss": float(utils.hybrid_loss_and_grad(s["h"], *args)[0])}, repeat))
+    return results
+
+
+def bench_smart_optimize(horizons, seeds, repeat, dt=10):
+    results = []
+    for seed in seeds:
+        s = scenario(5, seed)
+        for hours in horizons:
+            steps = hours * 3600 // dt
+            # finite differences cost n_gates + 1 simulations per gradient: about
+            # 4x the adjoint with the compiled kernel, minutes beyond a few
+            # hours with the NumPy engine
+            for jac in ["adjoint", None] if hours <= 6 or kernels.HAVE_NUMBA else ["adjoint"]:
+                params = {"hours": hours, "dt": dt, "seed": seed, "jac": jac, "steps": steps}
+
+                def fn():
+                    _, loss, _ = utils.smart_optimize_gates(
+                        q0=s["q0"], q_target=12.0, initial_ys=s["initial_ys"], Cds=s["Cds"],
+                        y_min=6, y_max=12, dt=dt, steps=steps, jac=jac)
+                    return {"loss": float(loss)}
+
+                results.append(run_case("smart_optimize_gates", params, fn, repeat))
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in json.load(f)["results"]}
+    print(f"\nComparison against {baseline_path} (ratio < 1 is faster)")
+    for r in results:
+        old = baseline.get((r["name"], json.dumps(r["params"], sort_keys=True)))
+        if old:
+            print(f"{r['name']:28s} {json.dumps(r['params']):60s} x{r['min'] / old['min']:.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default="bench.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="1h/6h horizons, dt=10, 5 gates only")
+    parser.add_argument("--horizons", type=int, nargs="+", help="horizons in hours")
+    parser.add_argument("--dts", type=int, nargs="+")
+    parser.add_argument("--gates", type=int, nargs="+")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1])
+    parser.add_argument("--skip-optimizer", action="store_true")
+    parser.add_argument("--backend", default="auto", choices=kernels.BACKENDS, help="simulate_gates_over_time backend")
+    args = parser.parse_args(argv)
+
+    horizons = args.horizons or ([1, 6] if args.quick else HORIZONS_H)
+    dts = args.dts or ([10] if args.quick else DTS)
+    gates = args.gates or ([5] if args.quick else GATE_COUNTS)
+    opt_horizons = [h for h in horizons if h in OPTIMIZER_HORIZONS_H]
+
+    results = bench_simulate_gates(args.repeat)
+    if kernels.resolve_backend(args.backend) == "numba":
+        utils.simulate_gates_over_time(100, [0.5] * 5, [11, 10, 9, 8, 7], [0.5] * 5, steps=1, backend="numba")  # JIT warm-up
+    results += bench_simulate_gates_over_time(horizons, dts, gates, args.repeat, args.backend)
+    results += bench_hybrid_loss(horizons, args.repeat)
+    if not args.skip_optimizer:
+        results += bench_smart_optimize(opt_horizons, args.seeds, 1)
+
+    with open(args.out, "w") as f:
+        json.dump({"meta": metadata(), "results": results}, f, indent=2)
+    print(f"\nWrote {len(results)} results to {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
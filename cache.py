@@ -0,0 +1,277 @@
+import copy
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from store import ResultStore
+from utils import GateSimulator, simulate_gates, simulate_gates_over_time, smart_optimize_gates
+
+
+def quantize(value, quantum=0.1):
+    # Floats snap to the UI grid (quantum=None keeps them exact), containers
+    # are canonicalized to tuples.
+    # Ints, strings, None... pass through untouched (steps must stay an int).
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (float, np.floating)):
+        if quantum is None:
+            return float(value)
+        return round(round(float(value) / quantum) * quantum, 10)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.ndarray):
+        return tuple(quantize(v, quantum) for v in value.tolist())
+    if isinstance(value, (list, tuple)):
+        return tuple(quantize(v, quantum) for v in value)
+    return value
+
+
+class SimulationCache:
+    """Process-wide LRU cache with TTL for simulation/optimization results.
+
+    Keys are built from the bound call arguments quantized to ``quantum``;
+    the wrapped function still runs on the caller's exact arguments, so a
+    hit serves the result of the first call whose inputs fell in that
+    quantization cell.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600, quantum=0.1, copy_values=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.quantum = quantum
+        # Results are copied in and out so callers can't mutate cached arrays;
+        # turn off for shared stateful objects such as GateSimulator.
+        self.copy_values = copy_values
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, copy.deepcopy(value) if self.copy_values else value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), copy.deepcopy(value) if self.copy_values else value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+    def wrap(self, fn, exact=("steady_tol", "tol", "target_loss"), ignore=("callback", "initial_guess", "previous")):
+        # Arguments named in ``exact`` (tolerances, inputs that are not on the
+        # UI grid) are keyed as given, without rounding.
+        # Arguments named in ``ignore`` (progress callbacks, optimizer warm
+        # starts) are passed through but left out of the key.
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            quantized = {name: v if name in ignore else quantize(v, None if name in exact else self.quantum) for name, v in bound.arguments.items()}
+            key = (fn.__module__, fn.__qualname__) + tuple(sorted((name, v) for name, v in quantized.items() if name not in ignore))
+            hit, value = self.get(key)
+            if hit:
+                return value
+            value = fn(*bound.args, **bound.kwargs)
+            self.put(key, value)
+            return value
+
+        wrapper.cache = self
+        return wrapper
+
+
+class ByteSizeCache:
+    """LRU cache of bytes values (e.g. rendered PNGs) bounded by total size."""
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._data[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._data),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class SolutionStore:
+    """Recent optimal gate openings, looked up by nearest neighbour.
+
+    Entries are keyed by ``(q0, q_target, initial_ys)``; ``nearest`` returns
+    the stored openings whose key is closest, with flows measured in units of
+    ``flow_scale`` cms and levels in metres, as a warm start for
+    smart_optimize_gates.
+    """
+
+    def __init__(self, maxsize=512, flow_scale=10.0, max_distance=None):
+        self.maxsize = maxsize
+        self.flow_scale = flow_scale
+        self.max_distance = max_distance
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, q0, q_target, initial_ys):
+        return (float(q0), float(q_target)) + tuple(float(y) for y in initial_ys)
+
+    def _point(self, key):
+        return np.array([key[0] / self.flow_scale, key[1] / self.flow_scale] + list(key[2:]))
+
+    def add(self, q0, q_target, initial_ys, x):
+        key = self._key(q0, q_target, initial_ys)
+        with self._lock:
+            self._data[key] = np.array(x, dtype=float)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def nearest(self, q0, q_target, initial_ys):
+        """Openings stored for the closest key, or None."""
+        key = self._key(q0, q_target, initial_ys)
+        with self._lock:
+            candidates = [(k, x) for k, x in self._data.items() if len(k) == len(key)]
+            if not candidates:
+                self.misses += 1
+                return None
+            point = self._point(key)
+            distances = [np.linalg.norm(self._point(k) - point) for k, _ in candidates]
+            best = int(np.argmin(distances))
+            if self.max_distance is not None and distances[best] > self.max_distance:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return candidates[best][1].copy()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+# Results on disk survive restarts and redeploys and are shared by every
+# worker process. The default lives in the user's data directory, not next
+# to the code; GATE_RESULT_STORE="" turns the store off
+_data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+_store_path = os.environ.get("GATE_RESULT_STORE", os.path.join(_data_home, "water-gate-ai", "gate_results.sqlite"))
+result_store = ResultStore(_store_path, max_bytes=int(os.environ.get("GATE_RESULT_STORE_MB", "512")) * 2**20) if _store_path else None
+
+
+def _persistent(fn):
+    return fn if result_store is None else result_store.wrap(fn)
+
+
+simulation_cache = SimulationCache()
+
+# Memory first, then disk, then compute
+cached_simulate_gates = simulation_cache.wrap(simulate_gates, exact=("h",))  # openings may be optimizer output, see cached_simulator
+cached_simulate_gates_over_time = simulation_cache.wrap(_persistent(simulate_gates_over_time))
+cached_smart_optimize_gates = simulation_cache.wrap(_persistent(smart_optimize_gates))
+
+# Resumable simulators keyed on everything but the horizon, so extending or
+# shortening "เลือกเวลาทำนาย" reuses the steps already taken by any session.
+# Keyed on the exact inputs: openings come from the optimizer as often as
+# from the 0.1-step inputs, and forecast_final_state's results are persisted
+simulator_cache = SimulationCache(maxsize=64, copy_values=False)
+cached_simulator = simulator_cache.wrap(GateSimulator, exact=("q0", "h", "initial_ys", "Cds", "gate_width", "length"))
+
+
+def forecast_final_state(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, dt=10, steps=360):
+    # The app's forecast: final flow row and levels after ``steps``, from the
+    # shared resumable simulator for exactly these inputs
+    return cached_simulator(q0, h, initial_ys=initial_ys, Cds=Cds, dt=dt).final_state(steps)
+
+
+# Memory, then disk (so a restarted app answers the usual forecasts without
+# simulating), then the exact simulator. The quantized memory layer stays
+# outside the store, which only ever sees exact results
+cached_forecast_final_state = simulation_cache.wrap(_persistent(forecast_final_state), exact=("h",))
+
+# Rendered gate diagrams, shared by every session
+gate_image_cache = ByteSizeCache(max_bytes=64 * 2**20)
+
+# Optimal openings from every session, the warm start for the next optimize
+solution_store = SolutionStore()
@@ -0,0 +1,72 @@
+"""Cold-start budget for the app pages and the command-line tools.
+
+    python check_imports.py              # fails (exit 1) when over budget
+    python check_imports.py --scale 2    # slower machine: double every budget
+
+Each path imports the modules its entry point imports, in a fresh
+interpreter, a few times; the median wall time must stay within the
+budget and none of the modules that path is supposed to load lazily may
+show up in sys.modules. The module lists mirror app.py's top-level imports
+(What-If) plus what the AI Mode branch imports, cli.py before it parses
+its arguments, and service.py.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# name: (modules imported, budget in ms, modules that must stay unloaded)
+PATHS = {
+    "what-if": (["cache", "plot", "profiling"], 1000,
+                ["scipy", "numba", "pandas", "matplotlib.pyplot", "pyarrow"]),
+    "ai-mode": (["cache", "plot", "profiling", "jobs", "mpc"], 1500,
+                ["numba", "pandas", "matplotlib.pyplot", "scipy.stats", "pyarrow"]),
+    "cli": (["cli"], 100,
+            ["numpy", "scipy", "numba", "matplotlib", "pandas", "pyarrow"]),
+    "service": (["service"], 400,
+                ["numba", "matplotlib", "pandas", "scipy.stats", "pyarrow"]),
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+print(json.dumps({{"ms": (time.perf_counter() - start) * 1000, "loaded": sorted(sys.modules)}}))
+"""
+
+
+def measure(modules, repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", PROBE.format(modules=modules)], capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout))
+    return statistics.median(r["ms"] for r in runs), set(runs[-1]["loaded"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget (slow CI machines)")
+    parser.add_argument("paths", nargs="*", help=f"any of {', '.join(PATHS)} (default: all)")
+    args = parser.parse_args(argv)
+    unknown = set(args.paths) - set(PATHS)
+    if unknown:
+        parser.error(f"unknown paths {sorted(unknown)}")
+
+    failures = 0
+    for name in args.paths or PATHS:
+        modules, budget, lazy = PATHS[name]
+        ms, loaded = measure(modules, args.repeat)
+        budget *= args.scale
+        eager = [m for m in lazy if m in loaded]
+        ok = ms <= budget and not eager
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name:8s} {ms:7.0f} ms (budget {budget:.0f} ms), {len(loaded)} modules"
+              + (f", loaded eagerly: {', '.join(eager)}" if eager else ""))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
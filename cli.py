@@ -0,0 +1,218 @@
+"""Batch forecasts and optimizations from scenario files, without Streamlit.
+
+    python cli.py simulate scenarios.csv --out forecasts.jsonl --workers 4
+    python cli.py optimize scenarios.json --out plans.csv --steps 2160
+
+Scenario files hold one scenario per row (CSV, Parquet) or object (JSON
+list or JSON Lines). Fields are keyword arguments of
+simulate_gates_over_time / smart_optimize_gates. Per-gate vectors are
+given as JSON lists, or as numbered columns like the sweep output
+(h_1..h_n, initial_y_1.., Cd_1.., y_target_1.., initial_guess_1..).
+Fields only the other mode uses are ignored, so one file can drive both;
+in optimize mode h (the current openings) is the warm start.
+
+One result row per scenario is streamed to --out (.jsonl or .csv, default
+JSON Lines on stdout) as soon as it finishes, so rows may come out of
+order; the "scenario" field is the input row number. Progress goes to
+stderr. Only the standard library is imported until the arguments are
+parsed; the solver (NumPy/SciPy) loads when the run starts. With --store
+results are read from and written to a shared on-disk result store, so a
+rerun of the same scenarios is instant.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import time
+
+VECTOR_COLUMNS = {"h": "h", "initial_y": "initial_ys", "Cd": "Cds", "y_target": "y_target", "initial_guess": "initial_guess"}
+INTEGER_FIELDS = ("steps", "dt", "polish_iter")
+_NUMBERED = re.compile(r"^(%s)_(\d+)$" % "|".join(VECTOR_COLUMNS))
+
+
+def _cell(value):
+    # CSV cells: numbers, JSON lists, empty (= not given) or plain strings
+    if isinstance(value, str):
+        value = value.strip()
+        if value == "":
+            return None
+        if value[0] in "[{":
+            return json.loads(value)
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _scenario(row):
+    # One flat row -> keyword arguments, numbered columns folded into lists
+    kwargs, vectors = {}, {}
+    for name, value in row.items():
+        value = _cell(value)
+        if value is None:
+            continue
+        match = _NUMBERED.match(name)
+        if match:
+            vectors.setdefault(VECTOR_COLUMNS[match.group(1)], {})[int(match.group(2))] = value
+        else:
+            kwargs[name] = value
+    for name, items in vectors.items():
+        kwargs[name] = [items[i] for i in sorted(items)]
+    for name in INTEGER_FIELDS:
+        if name in kwargs:
+            kwargs[name] = int(kwargs[name])
+    return kwargs
+
+
+def read_scenarios(path):
+    """Scenario kwargs from a .csv, .json, .jsonl/.ndjson or .parquet file."""
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+    elif suffix in (".jsonl", ".ndjson"):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    elif suffix == ".json":
+        with open(path, encoding="utf-8") as f:
+            rows = json.load(f)
+        rows = rows if isinstance(rows, list) else [rows]
+    elif suffix == ".parquet":
+        import pyarrow.parquet as pq
+        rows = pq.read_table(path).to_pylist()
+    else:
+        raise ValueError(f"unsupported scenario file {path!r}: use .csv, .json, .jsonl or .parquet")
+    return [_scenario(row) for row in rows]
+
+
+def _arguments(fn, kwargs):
+    # The same file can drive both modes: drop the other mode's fields
+    import inspect
+    from utils import simulate_gates_over_time, smart_optimize_gates
+
+    known = set(inspect.signature(simulate_gates_over_time).parameters) | set(inspect.signature(smart_optimize_gates).parameters)
+    unknown = set(kwargs) - known
+    if unknown:
+        raise TypeError(f"unknown scenario fields {sorted(unknown)}")
+    accepted = inspect.signature(fn).parameters
+    return {name: value for name, value in kwargs.items() if name in accepted}
+
+
+def _run_one(mode, index, kwargs, store=None):
+    # Runs in a worker process: one scenario -> one flat result row
+    import numpy as np
+    from utils import simulate_gates_over_time, smart_optimize_gates
+
+    fn = simulate_gates_over_time if mode == "simulate" else smart_optimize_gates
+    if mode == "optimize" and "h" in kwargs and "initial_guess" not in kwargs:
+        kwargs = dict(kwargs, initial_guess=kwargs["h"])  # current openings as the warm start
+    kwargs = _arguments(fn, kwargs)
+    if store is not None:
+        from store import ResultStore
+        fn = ResultStore(store).wrap(fn)
+
+    row = {"scenario": index}
+    if mode == "simulate":
+        qs, ys = fn(**kwargs)
+    else:
+        h, loss, (qs, ys) = fn(**kwargs)
+        row.update({f"h_{i + 1}": float(v) for i, v in enumerate(h)})
+        row["loss"] = float(loss)
+    row.update({f"y_final_{i + 1}": float(v) for i, v in enumerate(ys[-1])})
+    row.update({f"q_final_{i}": float(v) for i, v in enumerate(qs[-1])} if len(qs) else {})
+    row["level_min"] = float(np.min(ys))
+    row["level_max"] = float(np.max(ys))
+    return row
+
+
+class _Writer:
+    # Streams rows as JSON Lines or CSV (header from the first row)
+    def __init__(self, f, fmt):
+        self.f, self.fmt, self.csv = f, fmt, None
+
+    def write(self, row):
+        if self.fmt == "jsonl":
+            self.f.write(json.dumps(row) + "\n")
+        else:
+            if self.csv is None:
+                self.csv = csv.DictWriter(self.f, fieldnames=list(row), extrasaction="ignore")
+                self.csv.writeheader()
+            self.csv.writerow(row)
+        self.f.flush()
+
+
+def _progress(done, failed, total, started, final=False):
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = (total - done) / rate if rate else float("nan")
+    sys.stderr.write(f"\r[{done}/{total}] {100 * done / max(total, 1):5.1f}%  {rate:6.1f} scenarios/s  "
+                     f"ETA {eta:5.0f} s  failed {failed}" + ("\n" if final else ""))
+    sys.stderr.flush()
+
+
+def run(mode, scenarios, out, fmt="jsonl", workers=None, defaults=None, quiet=False, store=None):
+    """Run every scenario and stream rows to ``out``; returns the failure count."""
+    defaults = defaults or {}
+    jobs = [(i, dict(defaults, **kwargs)) for i, kwargs in enumerate(scenarios)]
+    writer = _Writer(out, fmt)
+    started = last_report = time.perf_counter()
+    done = failed = 0
+
+    def finished(index, row, error):
+        nonlocal done, failed, last_report
+        done += 1
+        if error is None:
+            writer.write(row)
+        else:
+            failed += 1
+            sys.stderr.write(f"\rscenario {index} failed: {error}".ljust(72) + "\n")
+        if not quiet and (time.perf_counter() - last_report > 0.5 or done == len(jobs)):
+            last_report = time.perf_counter()
+            _progress(done, failed, len(jobs), started, final=done == len(jobs))
+
+    if workers == 1:
+        for index, kwargs in jobs:
+            try:
+                finished(index, _run_one(mode, index, kwargs, store), None)
+            except Exception as exc:
+                finished(index, None, f"{type(exc).__name__}: {exc}")
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_run_one, mode, index, kwargs, store): index for index, kwargs in jobs}
+            for future in as_completed(futures):
+                try:
+                    finished(futures[future], future.result(), None)
+                except Exception as exc:
+                    finished(futures[future], None, f"{type(exc).__name__}: {exc}")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=("simulate", "optimize"))
+    parser.add_argument("scenarios", help="scenario file (.csv, .json, .jsonl, .parquet)")
+    parser.add_argument("--out", default="-", help="output .jsonl or .csv file (default: JSON Lines on stdout)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count, 1 = in-process)")
+    parser.add_argument("--steps", type=int, default=None, help="default horizon in steps for scenarios without one")
+    parser.add_argument("--dt", type=int, default=None, help="default step in seconds for scenarios without one")
+    parser.add_argument("--store", default=None, help="SQLite result store shared by the workers (e.g. gate_results.sqlite)")
+    parser.add_argument("--quiet", action="store_true", help="no progress report")
+    args = parser.parse_args(argv)
+
+    scenarios = read_scenarios(args.scenarios)
+    defaults = {name: value for name, value in (("steps", args.steps), ("dt", args.dt)) if value is not None}
+    fmt = "csv" if args.out.lower().endswith(".csv") else "jsonl"
+    if args.out == "-":
+        failed = run(args.mode, scenarios, sys.stdout, fmt, args.workers, defaults, args.quiet, args.store)
+    else:
+        with open(args.out, "w", newline="", encoding="utf-8") as f:
+            failed = run(args.mode, scenarios, f, fmt, args.workers, defaults, args.quiet, args.store)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Background optimization jobs for the Streamlit app.
+
+    job_id = job_runner.submit(cached_smart_optimize_gates, q0=120, ...)
+    job_runner.status(job_id)   # {"state": "running", "iterations": 4, "best_fun": ..., ...}
+    job_runner.cancel(job_id)
+
+Jobs run in a thread pool shared by every session, so a long optimization
+never blocks the page that started it, or anyone else's. The submitted
+function must accept a scipy-style ``callback(intermediate_result)``
+(smart_optimize_gates does); the runner uses it to publish the best-so-far
+openings after every iteration and to stop a cancelled job.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = "queued", "running", "done", "cancelled", "failed"
+
+
+class JobCancelled(Exception):
+    # Raised from the minimize callback; propagates past the result cache
+    # so a cut-short optimization is never stored
+    pass
+
+
+class Job:
+    def __init__(self, job_id, fn, kwargs, collect_metrics):
+        self.id = job_id
+        self.fn = fn
+        self.kwargs = kwargs
+        self.collect_metrics = collect_metrics
+        self.state = QUEUED
+        self.iterations = 0
+        self.best_x = None
+        self.best_fun = None
+        self.result = None
+        self.error = None
+        self.metrics = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "iterations": self.iterations,
+            "best_x": None if self.best_x is None else self.best_x.copy(),
+            "best_fun": self.best_fun,
+            "result": self.result,
+            "error": self.error,
+            "metrics": self.metrics,
+            "elapsed_s": ((self.finished or time.time()) - self.started) if self.started else 0.0,
+        }
+
+
+class JobRunner:
+    """Thread-pool job queue with IDs, best-so-far progress and cancel."""
+
+    def __init__(self, max_workers=4, keep=3600):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gate-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.keep = keep  # seconds a finished job stays queryable
+
+    def submit(self, fn, collect_metrics=False, **kwargs):
+        """Queue ``fn(**kwargs, callback=...)``; returns the job ID."""
+        job = Job(uuid.uuid4().hex, fn, kwargs, collect_metrics)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job)
+        return job.id
+
+    def _run(self, job):
+        with self._lock:
+            if job.cancel_requested.is_set():
+                job.state, job.finished = CANCELLED, time.time()
+                return
+            job.state, job.started = RUNNING, time.time()
+
+        def progress(intermediate_result):
+            with self._lock:
+                job.iterations += 1
+                if job.best_fun is None or intermediate_result.fun <= job.best_fun:
+                    job.best_x = intermediate_result.x.copy()
+                    job.best_fun = float(intermediate_result.fun)
+            if job.cancel_requested.is_set():
+                raise JobCancelled(job.id)
+
+        metrics = profiling.Metrics() if job.collect_metrics else None
+        token = profiling.activate(metrics)
+        try:
+            result = job.fn(**job.kwargs, callback=progress)
+            state, error = DONE, None
+        except JobCancelled:
+            result, state, error = None, CANCELLED, None
+        except Exception as exc:  # reported through status(), not raised in the pool
+            result, state, error = None, FAILED, f"{type(exc).__name__}: {exc}"
+        finally:
+            profiling.deactivate(token)
+        with self._lock:
+            job.result, job.state, job.error = result, state, error
+            job.metrics = None if metrics is None else metrics.summary()
+            job.finished = time.time()
+
+    def status(self, job_id):
+        """A copy of the job's state, or None for an unknown/expired ID."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job.snapshot()
+
+    def cancel(self, job_id):
+        """Ask a job to stop; it ends at its next optimizer iteration."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state in (DONE, CANCELLED, FAILED):
+                return False
+            job.cancel_requested.set()
+            if job.future is not None and job.future.cancel():
+                job.state, job.finished = CANCELLED, time.time()
+            return True
+
+    def _prune(self):
+        cutoff = time.time() - self.keep
+        for job_id in [j.id for j in self._jobs.values() if j.finished is not None and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+        return {state: states.count(state) for state in (QUEUED, RUNNING, DONE, CANCELLED, FAILED)}
+
+
+# Shared by every Streamlit session in this server process
+job_runner = JobRunner()
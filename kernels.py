@@ -0,0 +1,201 @@
+"""Compiled time-stepping kernel for the gate simulator.
+
+The whole implicit time loop (residual, tridiagonal Newton solve, flow
+recomputation) and the adjoint sweep back through it, written as plain
+scalar loops and compiled with numba's njit when numba is installed.
+Without numba, utils uses its vectorized NumPy engine instead; see
+resolve_backend.
+
+numba itself is only imported by the first compiled run (integrate_kernel),
+so importing the simulator stays cheap for code that never runs it.
+"""
+import importlib.util
+import math
+
+import numpy as np
+
+BACKENDS = ("auto", "numpy", "numba")
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None  # optional dependency
+
+
+def resolve_backend(backend="auto"):
+    """Map a backend= argument to the engine that will actually run."""
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+    if backend == "numba" and not HAVE_NUMBA:
+        raise ImportError("backend='numba' requires numba (pip install numba)")
+    if backend == "auto":
+        return "numba" if HAVE_NUMBA else "numpy"
+    return backend
+
+
+def _integrate_kernel(coef, ys0, q0, inflow, has_inflow, ys_prev, has_prev, dt, steps, a_reservoir, steady_tol, tol, max_iter, qs_out, ys_out):
+    # Same scheme as utils._iter_steps/_newton_step, one scenario at a time.
+    # coef is (N, 1, n) for fixed gates or (N, steps, n) for a schedule;
+    # with has_inflow, inflow[s, t] feeds step t instead of the last outflow.
+    # Returns (nonlinear solves, residual evaluations, steps skipped).
+    N, n_coef, n = coef.shape
+    k = dt / a_reservoir
+    y = np.empty(n)
+    y_new = np.empty(n)
+    before = np.empty(n)
+    F = np.empty(n)
+    dq = np.empty(n)
+    diag = np.empty(n)
+    c = np.empty(n)
+    d = np.empty(n)
+    solves = 0
+    evaluations = 0
+    skipped = 0
+
+    for s in range(N):
+        for i in range(n):
+            y[i] = ys0[s, i]
+            ys_out[s, 0, i] = y[i]
+            before[i] = ys_prev[s, i]
+        have_before = has_prev
+        q_in = q0[s]
+
+        for t in range(steps):
+            ct = t if n_coef > 1 else 0
+            if has_inflow:
+                q_in = inflow[s, t]
+            # Levels move smoothly, so extrapolating the last change is a good first guess
+            for i in range(n):
+                y_new[i] = 2 * y[i] - before[i] if have_before else y[i]
+
+            for iteration in range(1, max_iter + 1):
+                # Residual and tridiagonal Jacobian (diag, off=-dq[:-1])
+                q_up = q_in
+                for i in range(n):
+                    delta_h = y_new[i] - (y_new[i + 1] if i + 1 < n else 0.0)
+                    if delta_h > 0.1:
+                        sq = math.sqrt(delta_h)
+                        dq[i] = 0.5 * k * coef[s, ct, i] / sq
+                    else:
+                        sq = math.sqrt(0.1)
+                        dq[i] = 0.0
+                    q_out = coef[s, ct, i] * sq
+                    F[i] = y_new[i] - y[i] + (q_out - q_up) * k
+                    q_up = q_out
+                for i in range(n):
+                    diag[i] = 1 + dq[i] + (dq[i - 1] if i > 0 else 0.0)
+
+                # Thomas algorithm, off-diagonals are -dq[i]
+                denom = diag[0]
+                d[0] = F[0] / denom
+                for i in range(1, n):
+                    c[i - 1] = -dq[i - 1] / denom
+                    denom = diag[i] + dq[i - 1] * c[i - 1]
+                    d[i] = (F[i] + dq[i - 1] * d[i - 1]) / denom
+                for i in range(n - 2, -1, -1):
+                    d[i] -= c[i] * d[i + 1]
+
+                largest = 0.0
+                for i in range(n):
+                    y_new[i] -= d[i]
+                    if abs(d[i]) > largest:
+                        largest = abs(d[i])
+                if largest < tol:
+                    break
+            solves += 1
+            evaluations += iteration
+
+            for i in range(n):
+                before[i] = y[i]
+                y[i] = y_new[i]
+                ys_out[s, t + 1, i] = y[i]
+            qs_out[s, t, 0] = q_in
+            for i in range(n):
+                qs_out[s, t, i + 1] = coef[s, ct, i] * math.sqrt(max(y[i] - 0.5, 0.1))
+            have_before = True
+            q_in = qs_out[s, t, n]  # optional: assume last outflow feeds next time step
+
+            if steady_tol > 0 and 0 < t < steps - 1:
+                change = 0.0
+                for i in range(n):
+                    change = max(change, abs(y[i] - before[i]))
+                for i in range(n + 1):
+                    change = max(change, abs(qs_out[s, t, i] - qs_out[s, t - 1, i]))
+                if change * (steps - t - 1) < steady_tol:
+                    for u in range(t + 1, steps):
+                        for i in range(n + 1):
+                            qs_out[s, u, i] = qs_out[s, t, i]
+                        for i in range(n):
+                            ys_out[s, u + 1, i] = y[i]
+                    skipped += steps - t - 1
+                    break
+
+    return solves, evaluations, skipped
+
+
+def _adjoint_kernel(h, coef, qs, ys, dt, a_reservoir, gy_final, grad):
+    # Backward sweep of utils._adjoint_gradient for one trajectory: the
+    # tridiagonal J^T mu = a solve of every step, newest first, with
+    # dL/dh accumulated into grad (length n) on the way.
+    steps, n = qs.shape[0], ys.shape[1]
+    k = dt / a_reservoir
+    lam = np.empty(n)
+    mu = np.empty(n)
+    dq = np.empty(n)
+    c = np.empty(n)
+    denom = np.empty(n)
+    for i in range(n):
+        lam[i] = gy_final[i]
+        grad[i] = 0.0
+    lam_u = 0.0
+    grad_u = 0.0
+
+    for t in range(steps - 1, -1, -1):
+        # Jacobian at the converged levels of step t: diag 1 + dq_i + dq_(i-1), off -dq_i
+        for i in range(n):
+            delta_h = ys[t + 1, i] - (ys[t + 1, i + 1] if i + 1 < n else 0.0)
+            dq[i] = 0.5 * k * coef[i] / math.sqrt(delta_h) if delta_h > 0.1 else 0.0
+        y_last = ys[t + 1, n - 1]
+        r_y = 0.5 * coef[n - 1] / math.sqrt(y_last - 0.5) if y_last - 0.5 > 0.1 else 0.0
+        lam[n - 1] += lam_u * r_y
+        grad_u += lam_u * qs[t, n] / h[n - 1]
+
+        # J is symmetric, so J^T mu = lam is the same Thomas solve
+        denom[0] = 1 + dq[0]
+        mu[0] = lam[0] / denom[0]
+        for i in range(1, n):
+            c[i - 1] = -dq[i - 1] / denom[i - 1]
+            denom[i] = 1 + dq[i] + dq[i - 1] + dq[i - 1] * c[i - 1]
+            mu[i] = (lam[i] + dq[i - 1] * mu[i - 1]) / denom[i]
+        for i in range(n - 2, -1, -1):
+            mu[i] -= c[i] * mu[i + 1]
+
+        # dF_i/dh_i = k q_out_i / h_i and dF_(i+1)/dh_i = -k q_out_i / h_i
+        for i in range(n):
+            delta_h = ys[t + 1, i] - (ys[t + 1, i + 1] if i + 1 < n else 0.0)
+            q_out = coef[i] * math.sqrt(max(delta_h, 0.1))
+            grad[i] -= k * q_out * (mu[i] - (mu[i + 1] if i + 1 < n else 0.0)) / h[i]
+            lam[i] = mu[i]
+        lam_u = k * mu[0]
+
+    grad[n - 1] += grad_u
+
+
+_compiled = None
+_compiled_adjoint = None
+
+
+def integrate_kernel(*args):
+    # _integrate_kernel compiled on first use (loaded from numba's on-disk
+    # cache after the first process). nogil: background optimization jobs
+    # (jobs.py) run kernels in parallel threads.
+    global _compiled
+    if _compiled is None:
+        from numba import njit
+        _compiled = njit(cache=True, nogil=True)(_integrate_kernel)
+    return _compiled(*args)
+
+
+def adjoint_kernel(*args):
+    # _adjoint_kernel, compiled on first use like integrate_kernel
+    global _compiled_adjoint
+    if _compiled_adjoint is None:
+        from numba import njit
+        _compiled_adjoint = njit(cache=True, nogil=True)(_adjoint_kernel)
+    return _compiled_adjoint(*args)
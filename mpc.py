@@ -0,0 +1,122 @@
+"""Rolling-horizon (model-predictive) gate control over an inflow profile.
+
+    from mpc import mpc_control
+    result = mpc_control(list(inflows.values()), initial_ys=[11, 10, 9, 8, 7], q_target=80)
+
+At every control interval the gate openings for the next ``horizon``
+intervals are re-optimized against the inflow profile (each interval's
+inflow held for all of its steps, as an inflow series), the first interval
+of that plan is applied, and the simulated state (levels plus the last
+step's levels for the Newton predictor) is carried into the next
+interval. Each solve starts from the previous plan shifted by one
+interval and stops when its ``time_budget`` runs out.
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+from scipy.optimize import minimize
+
+import profiling
+from utils import _hybrid_loss, _integrate, _step_coefficients
+
+MPCResult = namedtuple("MPCResult", "openings qs ys losses iterations solve_times")
+
+
+def _plan_losses(plans, inflows, ys0, ys_prev, coef_scale, dt, steps, loss_args, backend):
+    # Hybrid loss at the end of every interval, summed, for a batch of plans
+    # (N, horizon, n_gates); the intervals are chained through the levels
+    N, horizon, n_gates = plans.shape
+    ys = np.broadcast_to(ys0, (N, n_gates))
+    before = None if ys_prev is None else np.broadcast_to(ys_prev, (N, n_gates))
+    total = np.zeros(N)
+    for j in range(horizon):
+        qs, ys_run = _integrate(coef_scale * plans[:, j], ys, np.full(N, inflows[j]), dt, steps, ys_prev=before, backend=backend,
+                                inflow=np.full((N, steps), inflows[j]))
+        ys, before = ys_run[:, -1], ys_run[:, -2]
+        total += [_hybrid_loss(qs[s, -1], ys[s], *loss_args) for s in range(N)]
+    return total
+
+
+def _plan_loss_and_grad(x, shape, inflows, ys0, ys_prev, coef_scale, dt, steps, loss_args, backend, eps=1e-6):
+    # Forward differences, with the base plan and every perturbation run as
+    # one batch through the vectorized engine
+    plans = np.repeat(x[None, :], x.size + 1, axis=0)
+    plans[1:] += eps * np.eye(x.size)
+    losses = _plan_losses(plans.reshape(-1, *shape), inflows, ys0, ys_prev, coef_scale, dt, steps, loss_args, backend)
+    return losses[0], (losses[1:] - losses[0]) / eps
+
+
+def mpc_control(
+    inflows,
+    initial_ys=[11, 10, 9, 8, 7],
+    q_target=80,
+    y_target=None,
+    y_min=6,
+    y_max=12,
+    h0=None,
+    Cds=[0.6]*5,
+    gate_width=10.0,
+    dt=10,
+    interval=3600,
+    horizon=3,
+    time_budget=0.1,
+    maxiter=30,
+    backend="auto"
+):
+    """Closed-loop control over ``len(inflows)`` intervals of ``interval`` seconds.
+
+    ``inflows`` holds one inflow (cms) per interval; past its end the last
+    value is held. Returns an MPCResult with the applied openings
+    (n_intervals, n_gates), the closed-loop trajectory in
+    simulate_gates_over_time layout, and per-interval losses, optimizer
+    iterations and solve times. ``time_budget`` (s) caps each solve.
+    """
+    inflows = np.asarray(list(inflows), dtype=float)
+    n_intervals = len(inflows)
+    steps = int(interval // dt)
+    ys = np.asarray(initial_ys, dtype=float)
+    n_gates = len(ys)
+    coef_scale = _step_coefficients(np.ones(n_gates), np.broadcast_to(Cds, (n_gates,)), gate_width)
+    loss_args = (q_target, y_target, y_min, y_max)
+    bounds = [(0.1, 2)] * (horizon * n_gates)
+    plan = np.tile(np.full(n_gates, 0.5) if h0 is None else np.asarray(h0, dtype=float), (horizon, 1))
+    ys_prev = None
+
+    openings, qs_out, ys_out = [], [], [ys.copy()]
+    losses, iterations, solve_times = [], [], []
+    metrics = profiling.current()
+    for t in range(n_intervals):
+        window = inflows[np.minimum(np.arange(t, t + horizon), n_intervals - 1)]
+        args = ((horizon, n_gates), window, ys, ys_prev, coef_scale, dt, steps, loss_args, backend)
+        started = time.perf_counter()
+
+        def out_of_time(intermediate_result):
+            if time.perf_counter() - started > time_budget:
+                raise StopIteration
+
+        with profiling.timed("mpc_solve", metrics):
+            result = minimize(_plan_loss_and_grad, plan.ravel(), args=args, jac=True, bounds=bounds,
+                              callback=out_of_time, options={"maxiter": maxiter})
+        solve_times.append(time.perf_counter() - started)
+        iterations.append(result.nit)
+        plan = result.x.reshape(horizon, n_gates)
+
+        # Apply the first interval of the plan and carry the state forward
+        qs, ys_run = _integrate((coef_scale * plan[0])[None, :], ys[None, :], [inflows[t]], dt, steps,
+                                ys_prev=None if ys_prev is None else ys_prev[None, :], backend=backend,
+                                inflow=np.full((1, steps), inflows[t]))
+        ys, ys_prev = ys_run[0, -1], ys_run[0, -2]
+        openings.append(plan[0].copy())
+        qs_out.append(qs[0])
+        ys_out.append(ys_run[0, 1:])
+        losses.append(_hybrid_loss(qs[0, -1], ys, *loss_args))
+
+        # Warm start: the rest of the plan moves up one interval, the last repeats
+        plan = np.vstack([plan[1:], plan[-1:]])
+
+    if metrics is not None:
+        metrics.add("mpc_intervals", n_intervals)
+        metrics.add("optimizer_iterations", sum(iterations))
+    return MPCResult(np.array(openings), np.concatenate(qs_out), np.vstack(ys_out),
+                     np.array(losses), np.array(iterations), np.array(solve_times))
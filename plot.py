@@ -1,12 +1,11 @@
-import matplotlib.pyplot as plt
+import io
+
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
-from matplotlib.animation import FuncAnimation
-import numpy as np
 
 # import streamlit as st
 # from matplotlib.animation import FuncAnimation
-import tempfile
-import os
 
 from matplotlib.colors import LinearSegmentedColormap
 
@@ -73,65 +72,141 @@ custom_cmap = LinearSegmentedColormap.from_list("custom_blue", [light_blue, dark
 
 #     return fig
 
-def plot_gates(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12):
-    # Plotting
-    fig, ax = plt.subplots(figsize=(12, 5))
-    bar_width = 1.0
-    bars = ax.bar(gate_positions, water_levels, width=bar_width, color='deepskyblue', align='edge')
-    
-    # Max/Min lines
-    ax.axhline(y_max, color='red', linestyle='-', label='Max')
-    ax.axhline(y_min, color='orange', linestyle='-', label='Min')
-    
-    # Current water levels as grey dashed lines
-    if current_levels:
-        for i, level in zip(gate_positions, current_levels):
-            ax.hlines(level, i+1, i+1 + bar_width, colors='grey', linestyles='--', linewidth=2, label='Current Level' if i == gate_positions[1] else "")
-    
-    # Add gates and callouts
-    for i, height in zip(gate_positions, gate_heights):
-        if i != 0:
-            gate_height_m = height
-            gate_open_ratio = height / 2
-    
-            gate = Rectangle((i - 0.05, 0), 0.1, gate_height_m, facecolor='deepskyblue')
-            gatewall = Rectangle((i - 0.05, gate_height_m), 0.1, y_max - gate_height_m, edgecolor='black', facecolor='grey')
-            ax.add_patch(gate)
-            ax.add_patch(gatewall)
-    
-            # Callout
-            ax.annotate(f"{round(height,2)} m\n{gate_open_ratio:.2%}",
-                        xy=(i, gate_height_m),
-                        xytext=(i + 0.2, gate_height_m + 2),
-                        arrowprops=dict(facecolor='black', arrowstyle='->'),
-                        ha='right', fontsize=9,
-                        bbox=dict(boxstyle="round,pad=0.3", fc="lightyellow", ec="black", lw=0.5))
-    
-            # White dotted arrow
-            arrow_y = gate_height_m / 2
-            ax.annotate("",
-                        xy=(i + 0.08, arrow_y), xytext=(i - 0.06, arrow_y),
-                        arrowprops=dict(arrowstyle="->", linestyle=":", color='white', lw=2))
-    
-    # Water level labels
-    for i, h in zip(gate_positions, water_levels):
-        if i != 0:
-            ax.text(i + 0.5, h - 0.5, f"+{round(h,2)} m", ha='center', color='white', fontsize=10)
-    
-    # X labels
-    ax.set_xticks(gate_positions)
-    ax.set_xticklabels([f"{gate_names[i]}\nQ = {round(qs[i],2)} cms" for i in range(len(qs))])
-    
-    # Aesthetic
-    ax.set_ylim(0, 16)
-    ax.set_ylabel("Height (m)")
-    ax.set_title("Water Levels and Gate Openings")
-    ax.legend()
-    
-    plt.grid(axis='y', linestyle='--', alpha=0.4)
-    plt.tight_layout()
+class GatePlotRenderer:
+    """Gate diagram that is drawn once and then updated in place.
+
+    The first render() builds every artist (bars, gate patches, callouts,
+    labels); later calls only move/resize them and swap their text, which is
+    much cheaper than rebuilding the figure on every Streamlit rerun. The
+    figure is a plain matplotlib Figure, not registered with pyplot, so it is
+    freed with the renderer; call close() to release it explicitly.
+    """
+
+    def __init__(self, figsize=(12, 5), bar_width=1.0):
+        self.figsize = figsize
+        self.bar_width = bar_width
+        self.fig = None
+        self._n = None
+
+    def _build(self, gate_positions):
+        self.close()
+        self.fig = Figure(figsize=self.figsize)
+        ax = self.ax = self.fig.add_subplot()
+        self._n = len(gate_positions)
+        self._positions = list(gate_positions)
+        zeros = [0] * self._n
+        self.bars = ax.bar(gate_positions, zeros, width=self.bar_width, color='deepskyblue', align='edge')
+
+        # Max/Min lines
+        self.max_line = ax.axhline(0, color='red', linestyle='-', label='Max')
+        self.min_line = ax.axhline(0, color='orange', linestyle='-', label='Min')
+
+        # Current water levels as grey dashed lines
+        self.current = LineCollection([], colors='grey', linestyles='--', linewidth=2, label='_nolegend_')
+        ax.add_collection(self.current)
+        self._show_current = None
+
+        # Gates, callouts, flow arrows and level labels for every gate after C2
+        self.gates, self.walls, self.callouts, self.arrows, self.labels = {}, {}, {}, {}, {}
+        for i in gate_positions:
+            if i != 0:
+                self.gates[i] = ax.add_patch(Rectangle((i - 0.05, 0), 0.1, 0, facecolor='deepskyblue'))
+                self.walls[i] = ax.add_patch(Rectangle((i - 0.05, 0), 0.1, 0, edgecolor='black', facecolor='grey'))
+                self.callouts[i] = ax.annotate("",
+                            xy=(i, 0),
+                            xytext=(i + 0.2, 2),
+                            arrowprops=dict(facecolor='black', arrowstyle='->'),
+                            ha='right', fontsize=9,
+                            bbox=dict(boxstyle="round,pad=0.3", fc="lightyellow", ec="black", lw=0.5))
+                self.arrows[i] = ax.annotate("",
+                            xy=(i + 0.08, 0), xytext=(i - 0.06, 0),
+                            arrowprops=dict(arrowstyle="->", linestyle=":", color='white', lw=2))
+                self.labels[i] = ax.text(i + 0.5, 0, "", ha='center', color='white', fontsize=10)
+
+        # Aesthetic
+        ax.set_xticks(gate_positions)
+        ax.set_ylim(0, 16)
+        ax.set_ylabel("Height (m)")
+        ax.set_title("Water Levels and Gate Openings")
+        ax.grid(axis='y', linestyle='--', alpha=0.4)
+
+    def render(self, gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12):
+        """Update the diagram to a new state and return the figure."""
+        if self.fig is None or len(gate_positions) != self._n or list(gate_positions) != self._positions:
+            self._build(gate_positions)
+            first = True
+        else:
+            first = False
+        ax = self.ax
+
+        for bar, level in zip(self.bars, water_levels):
+            bar.set_height(level)
+        self.max_line.set_ydata([y_max, y_max])
+        self.min_line.set_ydata([y_min, y_min])
+
+        show_current = bool(current_levels)
+        if show_current:
+            self.current.set_segments([[(i + 1, level), (i + 1 + self.bar_width, level)]
+                                       for i, level in zip(gate_positions, current_levels)])
+        self.current.set_visible(show_current)
+        if show_current != self._show_current:
+            self.current.set_label('Current Level' if show_current else '_nolegend_')
+            ax.legend()
+            self._show_current = show_current
+
+        for i, height in zip(gate_positions, gate_heights):
+            if i != 0:
+                gate_open_ratio = height / 2
+                self.gates[i].set_height(height)
+                self.walls[i].set_y(height)
+                self.walls[i].set_height(y_max - height)
+                callout = self.callouts[i]
+                callout.set_text(f"{round(height,2)} m\n{gate_open_ratio:.2%}")
+                callout.xy = (i, height)
+                callout.set_position((i + 0.2, height + 2))
+                arrow = self.arrows[i]
+                arrow.xy = (i + 0.08, height / 2)
+                arrow.set_position((i - 0.06, height / 2))
+
+        for i, h in zip(gate_positions, water_levels):
+            if i != 0:
+                self.labels[i].set_position((i + 0.5, h - 0.5))
+                self.labels[i].set_text(f"+{round(h,2)} m")
+
+        ax.set_xticklabels([f"{gate_names[i]}\nQ = {round(qs[i],2)} cms" for i in range(len(qs))])
+        if first:
+            self.fig.tight_layout()
+        return self.fig
+
+    def render_png(self, gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12, dpi=200):
+        """render() rasterized to PNG bytes, with the same settings st.pyplot uses."""
+        fig = self.render(gate_names, gate_heights, gate_positions, water_levels, qs,
+                          current_levels=current_levels, y_min=y_min, y_max=y_max)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+        return buffer.getvalue()
+
+    def close(self):
+        if self.fig is not None:
+            self.fig.clear()
+            self.fig = None
+            self._n = None
+
+
+def display_key(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12):
+    # Everything that changes the picture, rounded to what the labels show
+    # (levels/flows to 0.01, gate heights to 0.0001 for the 0.01% opening ratio)
+    def rounded(values, digits=2):
+        return None if values is None else tuple(round(float(v), digits) for v in values)
+
+    return (tuple(gate_names), tuple(gate_positions), rounded(gate_heights, 4), rounded(water_levels),
+            rounded(qs), rounded(current_levels) if current_levels else None, round(float(y_min), 2), round(float(y_max), 2))
+
 
-    return fig
+def plot_gates(gate_names, gate_heights, gate_positions, water_levels, qs, current_levels=None, y_min=6, y_max=12):
+    # One-off render; keep a GatePlotRenderer around to redraw the same figure
+    return GatePlotRenderer().render(gate_names, gate_heights, gate_positions, water_levels, qs,
+                                     current_levels=current_levels, y_min=y_min, y_max=y_max)
 
 
 # def animate_ripple_color(gate_names, gate_heights, gate_positions, water_levels, qs, y_min=6, y_max=12):
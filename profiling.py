@@ -0,0 +1,84 @@
+"""Opt-in counters and timers for the solver stack.
+
+Nothing is recorded unless a Metrics object is active in the current
+context, so the hot loops only pay for one ContextVar lookup per call:
+
+    with profiling.collect() as metrics:
+        smart_optimize_gates(...)
+    print(metrics.summary())
+
+Metrics are per thread (ContextVar), so concurrent Streamlit sessions do
+not see each other's numbers.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("gate_metrics", default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.maxima = {}
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def observe_max(self, name, value):
+        if value > self.maxima.get(name, float("-inf")):
+            self.maxima[name] = value
+
+    def summary(self):
+        solves = self.counters.get("nonlinear_solves", 0)
+        summary = dict(self.counters)
+        summary.update(self.maxima)
+        summary.update({f"{name}_s": seconds for name, seconds in self.timers.items()})
+        if solves:
+            summary["residual_evaluations_per_solve"] = self.counters.get("residual_evaluations", 0) / solves
+        return summary
+
+
+def current():
+    """The active Metrics, or None when instrumentation is off."""
+    return _current.get()
+
+
+def activate(metrics):
+    """Make ``metrics`` (or None to disable) the active collector; returns a reset token."""
+    return _current.set(metrics)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+@contextmanager
+def collect(callback=None):
+    """Collect metrics for the enclosed block; ``callback(summary)`` runs on exit."""
+    metrics = Metrics()
+    token = activate(metrics)
+    try:
+        yield metrics
+    finally:
+        deactivate(token)
+        if callback is not None:
+            callback(metrics.summary())
+
+
+@contextmanager
+def timed(name, metrics=None):
+    # Time a block into ``name`` if instrumentation is on; no-op otherwise
+    metrics = metrics or current()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - start)
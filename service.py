@@ -0,0 +1,358 @@
+"""Headless HTTP service for the gate simulator (no Streamlit).
+
+    python service.py --port 8000                  # built-in asyncio server
+    uvicorn service:app --port 8000                # or any ASGI server
+
+Endpoints take a JSON object with the keyword arguments of the function of
+the same name and return JSON:
+
+    POST /simulate_gates              -> {"q": [...], "y": [...]}
+    POST /simulate_gates_over_time    -> {"qs": [[...]], "ys": [[...]]}   ("final_only": true for the last rows)
+    POST /smart_optimize_gates        -> {"h": [...], "loss": ..., "qs": ..., "ys": ...}
+    GET  /health                      -> queue and batching counters
+
+Solves run in a thread pool (the numba kernel releases the GIL).
+simulate_gates_over_time requests with a scalar q0 and fixed openings that
+arrive within ``batch_window`` seconds of each other, and share dt, steps,
+gate_width and gate count, are run as one simulate_gates_batch call. At
+most ``max_pending`` requests are accepted at a time; beyond that the
+service answers 503 with Retry-After instead of queueing without bound.
+Horizons are capped at ``max_steps`` steps so one request cannot hold a
+worker for long. Cds defaults to 0.6 for every gate in the request.
+"""
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import simulate_gates, simulate_gates_batch, simulate_gates_over_time, smart_optimize_gates
+
+MAX_BODY = 1 << 20
+
+SIMULATE_ARGS = ("q0", "h", "initial_y0", "Cds", "gate_width", "dt")
+OVER_TIME_ARGS = ("q0", "h", "initial_ys", "Cds", "gate_width", "dt", "steps", "steady_tol", "q0_times", "h_times")
+OPTIMIZE_ARGS = ("q0", "initial_y0", "q_target", "initial_ys", "y_target", "y_min", "y_max", "Cds", "dt", "steps",
+                 "jac", "polish_iter", "initial_guess")
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = list(headers)
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _kwargs(payload, allowed):
+    if not isinstance(payload, dict):
+        raise HTTPError(400, "request body must be a JSON object")
+    unknown = set(payload) - set(allowed) - {"final_only"}
+    if unknown:
+        raise HTTPError(400, f"unknown arguments {sorted(unknown)}")
+    kwargs = {name: payload[name] for name in allowed if name in payload}
+    if "Cds" not in kwargs:
+        # The functions' own default is five gates; size it from the request
+        gates = kwargs.get("h", kwargs.get("initial_guess", kwargs.get("initial_ys")))
+        if gates is not None:
+            try:
+                kwargs["Cds"] = [0.6] * np.shape(gates)[-1]
+            except (IndexError, ValueError):
+                raise HTTPError(400, "gate vectors must be lists of numbers")
+    return kwargs
+
+
+def _is_number(value, kind=(int, float)):
+    return isinstance(value, kind) and not isinstance(value, bool)
+
+
+class _Pending:
+    # One simulate_gates_over_time request waiting for its batch
+    __slots__ = ("key", "q0", "h", "initial_ys", "Cds", "future")
+
+    def __init__(self, key, q0, h, initial_ys, Cds, future):
+        self.key, self.q0, self.h, self.initial_ys, self.Cds, self.future = key, q0, h, initial_ys, Cds, future
+
+
+class SimulationService:
+    """ASGI application with micro-batching and bounded admission."""
+
+    def __init__(self, workers=None, batch_window=0.005, max_batch=256, max_pending=512, retry_after=1, max_steps=3 * 8640):
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.max_steps = max_steps  # 72 h at dt=10
+        self.pending = 0
+        self.counters = {"requests": 0, "rejected": 0, "batches": 0, "batched_requests": 0}
+        self._executor = None
+        self._queue = None
+        self._batcher = None
+        self._tasks = set()
+
+    # -- lifecycle -------------------------------------------------------
+
+    async def startup(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gate-service")
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def shutdown(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # -- solves ----------------------------------------------------------
+
+    def _admit(self):
+        if self.pending >= self.max_pending:
+            self.counters["rejected"] += 1
+            raise HTTPError(503, "service busy, retry later", [(b"retry-after", str(self.retry_after).encode())])
+        self.pending += 1
+        self.counters["requests"] += 1
+
+    async def _in_pool(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+
+    async def simulate(self, kwargs):
+        q, y = await self._in_pool(simulate_gates, **kwargs)
+        return {"q": q, "y": y}
+
+    async def simulate_over_time(self, kwargs):
+        q0 = np.asarray(kwargs.get("q0", 100.0), dtype=float)
+        h = np.asarray(kwargs.get("h"), dtype=float)
+        if q0.ndim or h.ndim != 1 or "q0_times" in kwargs or "h_times" in kwargs:
+            # Time-varying inputs don't share a step grid with anyone: run alone
+            return await self._in_pool(simulate_gates_over_time, **kwargs)
+        n = len(h)
+        key = (kwargs.get("dt", 10), kwargs.get("steps", 360), float(kwargs.get("gate_width", 10.0)), n, kwargs.get("steady_tol"))
+        initial_ys = np.broadcast_to(np.asarray(kwargs.get("initial_ys", [11, 10, 9, 8, 7]), dtype=float), (n,))
+        Cds = np.broadcast_to(np.asarray(kwargs.get("Cds", [0.6] * 5), dtype=float), (n,))
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Pending(key, float(q0), h, initial_ys, Cds, future))
+        return await future
+
+    async def optimize(self, kwargs):
+        x, fun, (qs, ys) = await self._in_pool(smart_optimize_gates, **kwargs)
+        return {"h": x, "loss": fun, "qs": qs, "ys": ys}
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                groups = {}
+                for item in batch:
+                    groups.setdefault(item.key, []).append(item)
+                for key, items in groups.items():
+                    task = asyncio.create_task(self._run_group(key, items))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            except Exception as exc:
+                # Only this batch fails; the loop keeps serving later requests
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(exc)
+
+    async def _run_group(self, key, items):
+        dt, steps, gate_width, _, steady_tol = key
+        self.counters["batches"] += 1
+        self.counters["batched_requests"] += len(items)
+        try:
+            qs, ys = await self._in_pool(
+                simulate_gates_batch, np.array([i.q0 for i in items]), np.stack([i.h for i in items]),
+                initial_ys=np.stack([i.initial_ys for i in items]), Cds=np.stack([i.Cds for i in items]),
+                gate_width=gate_width, dt=dt, steps=steps, steady_tol=steady_tol)
+        except Exception as exc:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+            return
+        for row, item in enumerate(items):
+            if not item.future.done():
+                item.future.set_result((qs[row], ys[row]))
+
+    # -- HTTP ------------------------------------------------------------
+
+    async def handle(self, method, path, body):
+        """(status, payload) for one request."""
+        if path == "/health":
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            return 200, dict(self.counters, pending=self.pending, max_pending=self.max_pending)
+        routes = {
+            "/simulate_gates": (SIMULATE_ARGS, self.simulate),
+            "/simulate_gates_over_time": (OVER_TIME_ARGS, self.simulate_over_time),
+            "/smart_optimize_gates": (OPTIMIZE_ARGS, self.optimize),
+        }
+        if path not in routes:
+            raise HTTPError(404, f"no endpoint {path}")
+        if method != "POST":
+            raise HTTPError(405, "use POST")
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "request body is not valid JSON")
+        allowed, handler = routes[path]
+        kwargs = _kwargs(payload, allowed)
+        steps = kwargs.get("steps", 360)
+        if not _is_number(steps, int) or not 0 <= steps <= self.max_steps:
+            raise HTTPError(400, f"steps must be an integer between 0 and {self.max_steps}")
+        if not _is_number(kwargs.get("dt", 10)) or not kwargs.get("dt", 10) > 0:
+            raise HTTPError(400, "dt must be a positive number")
+        if kwargs.get("steady_tol") is not None and not _is_number(kwargs["steady_tol"]):
+            raise HTTPError(400, "steady_tol must be a number or null")
+        self._admit()
+        try:
+            result = await handler(kwargs)
+        except (TypeError, ValueError, KeyError, IndexError) as exc:
+            raise HTTPError(400, f"{type(exc).__name__}: {exc}")
+        finally:
+            self.pending -= 1
+        if path == "/simulate_gates_over_time":
+            qs, ys = result
+            result = {"qs": qs[-1:] if payload.get("final_only") else qs, "ys": ys[-1:] if payload.get("final_only") else ys}
+        return 200, result
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await self.startup()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await self.shutdown()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        headers = []
+        try:
+            if len(body) > MAX_BODY:
+                raise HTTPError(413, "request body too large")
+            status, payload = await self.handle(scope["method"], scope["path"], body)
+        except HTTPError as exc:
+            status, payload, headers = exc.status, {"error": str(exc)}, exc.headers
+        data = json.dumps(payload, default=_json_default).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())] + headers})
+        await send({"type": "http.response.body", "body": data})
+
+
+app = SimulationService()
+
+
+# -- Local stand-in server ----------------------------------------------------
+# Just enough HTTP/1.1 (Content-Length bodies, keep-alive) to run the ASGI app
+# without an ASGI server installed.
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+async def _serve_connection(asgi, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, target, version = request_line.decode("latin-1").split()
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers.append((name.strip().lower().encode(), value.strip().encode()))
+            fields = dict(headers)
+            length = int(fields.get(b"content-length", b"0"))
+            if length > MAX_BODY:
+                writer.write(b"HTTP/1.1 413 Payload Too Large\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                break
+            body = await reader.readexactly(length) if length else b""
+            path, _, query = target.partition("?")
+            scope = {"type": "http", "http_version": version.split("/")[-1], "method": method, "path": path,
+                     "query_string": query.encode(), "headers": headers}
+
+            async def receive(body=body):
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            response = {}
+
+            async def send(message, response=response):
+                if message["type"] == "http.response.start":
+                    response["status"], response["headers"] = message["status"], message.get("headers", [])
+                else:
+                    response["body"] = response.get("body", b"") + message.get("body", b"")
+
+            await asgi(scope, receive, send)
+            status = response["status"]
+            head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n".encode()
+            head += b"".join(name + b": " + value + b"\r\n" for name, value in response["headers"])
+            writer.write(head + b"\r\n" + response.get("body", b""))
+            await writer.drain()
+            if fields.get(b"connection", b"").lower() == b"close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(asgi=app, host="127.0.0.1", port=8000):
+    await asgi.startup()
+    server = await asyncio.start_server(lambda r, w: _serve_connection(asgi, r, w), host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await asgi.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-window", type=float, default=0.005, help="seconds to wait for more requests to batch")
+    parser.add_argument("--max-pending", type=int, default=512)
+    parser.add_argument("--max-steps", type=int, default=3 * 8640, help="longest horizon a request may ask for, in steps")
+    args = parser.parse_args(argv)
+    service = SimulationService(workers=args.workers, batch_window=args.batch_window, max_pending=args.max_pending,
+                                max_steps=args.max_steps)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Persistent, content-addressed result store (SQLite).
+
+Results of simulate_gates_over_time / smart_optimize_gates survive
+restarts: the key is a SHA-256 of the function name, MODEL_VERSION and the
+canonical call arguments (defaults applied, numbers as float64, lists as
+arrays), the value the result's arrays in .npz form (no pickle). The file
+is shared safely by every worker process: SQLite in WAL mode, one
+connection per process and thread, and writes plus eviction in one
+IMMEDIATE transaction. Once the values exceed ``max_bytes`` the least
+recently read entries are evicted.
+
+    store = ResultStore("results.sqlite")
+    simulate = store.wrap(simulate_gates_over_time)
+"""
+import functools
+import hashlib
+import inspect
+import io
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Bump when a change to the solver changes its numbers, so stale results are never served
+MODEL_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    fn TEXT NOT NULL,
+    value BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+"""
+
+
+def _feed(h, value):
+    # Canonical byte stream of an argument value
+    if value is None:
+        h.update(b"N")
+    elif isinstance(value, (bool, np.bool_)):
+        h.update(b"B1" if value else b"B0")
+    elif isinstance(value, (int, float, np.integer, np.floating)):
+        h.update(b"F" + struct.pack("<d", float(value)))
+    elif isinstance(value, str):
+        data = value.encode()
+        h.update(b"S" + struct.pack("<q", len(data)) + data)
+    elif hasattr(value, "x") and not isinstance(value, np.ndarray):
+        _feed(h, value.x)  # OptimizeResult: only its solution is used
+    else:
+        try:
+            array = np.asarray(value, dtype=float)
+        except (TypeError, ValueError):
+            array = None
+        if array is not None:
+            h.update(b"A" + struct.pack("<q", array.ndim) + struct.pack(f"<{array.ndim}q", *array.shape))
+            h.update(np.ascontiguousarray(array).tobytes())
+        else:
+            items = list(value)
+            h.update(b"L" + struct.pack("<q", len(items)))
+            for item in items:
+                _feed(h, item)
+
+
+_digests = {}
+
+
+def file_digest(path):
+    """SHA-256 of a file's bytes, cached until its size or mtime changes."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def input_key(name, arguments):
+    """Hex digest for a function name and its bound arguments."""
+    h = hashlib.sha256(f"{name}\0{MODEL_VERSION}".encode())
+    for arg in sorted(arguments):
+        h.update(b"\0" + arg.encode() + b"=")
+        _feed(h, arguments[arg])
+    return h.hexdigest()
+
+
+def _pack(value):
+    # Nested tuples of arrays/numbers/None -> .npz bytes plus a JSON layout.
+    # Object arrays would need pickle, so they are refused (TypeError).
+    arrays = {}
+
+    def layout(v):
+        if v is None:
+            return None
+        if isinstance(v, (tuple, list)):
+            return [layout(item) for item in v]
+        array = np.asarray(v)
+        if array.dtype.hasobject:
+            raise TypeError(f"cannot store a {type(v).__name__} without pickle")
+        name = f"a{len(arrays)}"
+        arrays[name] = array
+        return {"array": name, "scalar": array.ndim == 0}
+
+    arrays["layout"] = np.frombuffer(json.dumps(layout(value)).encode(), dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _unpack(blob):
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        def build(node):
+            if node is None:
+                return None
+            if isinstance(node, list):
+                return tuple(build(item) for item in node)
+            array = data[node["array"]]
+            return array[()] if node["scalar"] else array
+
+        return build(json.loads(data["layout"].tobytes()))
+
+
+class ResultStore:
+    """Size-capped on-disk store shared by threads and processes."""
+
+    def __init__(self, path, max_bytes=512 * 2**20, timeout=30.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        # One connection per (process, thread); a forked child opens its own
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            try:
+                value = _unpack(row[0])
+            except Exception:
+                # Unreadable (e.g. written by an older version): drop it and recompute
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+        if row is None:
+            self.misses += 1
+            return False, None
+        try:
+            conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.OperationalError:
+            pass  # busy: the LRU order is only a hint
+        self.hits += 1
+        return True, value
+
+    def put(self, key, name, value):
+        try:
+            blob = _pack(value)
+        except TypeError:
+            return  # not storable without pickle: just not persisted
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", (key, name, blob, len(blob), now, now))
+            total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM results").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = conn.execute("SELECT key, nbytes FROM results WHERE key != ? ORDER BY accessed LIMIT 64", (key,)).fetchall()
+                if not oldest:
+                    break
+                for old_key, nbytes in oldest:
+                    conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    total -= nbytes
+                    self.evictions += 1
+                    if total <= self.max_bytes:
+                        break
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        self._connect().execute("DELETE FROM results")
+
+    def stats(self):
+        count, nbytes = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": count, "bytes": nbytes, "max_bytes": self.max_bytes}
+
+    def wrap(self, fn, ignore=("callback", "backend", "initial_guess", "previous"), files=("surrogate",)):
+        # Arguments named in ``ignore`` don't change the result and stay out of the key;
+        # a path given for an argument named in ``files`` is keyed by the file's content
+        signature = inspect.signature(fn)
+        name = f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {k: v for k, v in bound.arguments.items() if k not in ignore}
+            try:
+                for k in files:
+                    if isinstance(arguments.get(k), str):
+                        arguments[k] = "sha256:" + file_digest(arguments[k])
+                key = input_key(name, arguments)
+            except (TypeError, OSError):
+                return fn(*args, **kwargs)  # no canonical form (e.g. a GateSurrogate object, a missing file)
+            try:
+                hit, value = self.get(key)
+            except (sqlite3.Error, OSError):
+                hit = False  # an unreadable store only costs the recomputation
+            if hit:
+                return value
+            value = fn(*args, **kwargs)
+            try:
+                self.put(key, name, value)
+            except (sqlite3.Error, OSError):
+                pass
+            return value
+
+        wrapper.store = self
+        return wrapper
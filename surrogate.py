@@ -0,0 +1,144 @@
+"""Response-surface surrogate of simulate_gates_over_time for AI Mode.
+
+Offline build, and opting the app in to use it:
+
+    python surrogate.py --samples 4096 --out surrogate.npz
+    GATE_SURROGATE=surrogate.npz streamlit run app.py
+
+A scrambled Sobol design over (q0, initial_ys, h) is simulated once to
+the longest horizon with the batch engine. The final levels at every
+whole hour are fitted with a cubic polynomial ridge regression, one per
+hour. smart_optimize_gates(..., surrogate=...) optimizes on it and then
+polishes the answer on the true simulator.
+"""
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+from utils import _reported_flows, _step_coefficients, simulate_gates_batch
+
+N_GATES = 5
+# Design ranges: inflow (cms), initial levels (m), gate openings (m)
+Q0_RANGE = (50.0, 200.0)
+LEVEL_RANGE = (4.0, 14.0)
+GATE_RANGE = (0.1, 2.0)
+
+
+def _design_bounds():
+    lower = np.array([Q0_RANGE[0]] + [LEVEL_RANGE[0]] * N_GATES + [GATE_RANGE[0]] * N_GATES)
+    upper = np.array([Q0_RANGE[1]] + [LEVEL_RANGE[1]] * N_GATES + [GATE_RANGE[1]] * N_GATES)
+    return lower, upper
+
+
+def _monomials(n_inputs, degree):
+    return [combo for d in range(degree + 1) for combo in itertools.combinations_with_replacement(range(n_inputs), d)]
+
+
+def _monomial_index(monomials, degree):
+    # Each monomial as `degree` column indices into [1, u...]; padding picks the 1
+    return np.array([[i + 1 for i in combo] + [0] * (degree - len(combo)) for combo in monomials])
+
+
+def _features(u, index):
+    # u is scaled to [-1, 1]; one column per monomial
+    padded = np.concatenate([np.ones((u.shape[0], 1)), u], axis=1)
+    return padded[:, index].prod(axis=2)
+
+
+class GateSurrogate:
+    """Polynomial surrogate of the final levels after each whole hour."""
+
+    def __init__(self, coefficients, hours, lower, upper, degree, Cds, gate_width, dt, rmse=None):
+        self.coefficients = coefficients  # (n_hours, n_features, n_gates)
+        self.hours = np.asarray(hours)
+        self.lower, self.upper = lower, upper
+        self.degree = int(degree)
+        self.Cds = np.asarray(Cds, dtype=float)
+        self.gate_width = float(gate_width)
+        self.dt = int(dt)
+        self.rmse = rmse
+        self._index = _monomial_index(_monomials(len(lower), self.degree), self.degree)
+
+    def save(self, path):
+        np.savez(path, coefficients=self.coefficients, hours=self.hours, lower=self.lower, upper=self.upper,
+                 degree=self.degree, Cds=self.Cds, gate_width=self.gate_width, dt=self.dt,
+                 rmse=np.full(len(self.hours), np.nan) if self.rmse is None else self.rmse)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["coefficients"], data["hours"], data["lower"], data["upper"], data["degree"],
+                       data["Cds"], float(data["gate_width"]), int(data["dt"]), data["rmse"])
+
+    def check(self, Cds, dt):
+        if dt != self.dt or not np.allclose(np.broadcast_to(Cds, self.Cds.shape), self.Cds):
+            raise ValueError(f"surrogate was built for dt={self.dt}, Cds={self.Cds.tolist()}")
+
+    def predict(self, q0, initial_ys, h, steps):
+        """Flow row and levels after ``steps``, like ``qs[-1], ys[-1]``.
+
+        Horizons between two fitted hours are interpolated linearly.
+        """
+        hour = steps * self.dt / 3600
+        if not self.hours[0] <= hour <= self.hours[-1]:
+            raise ValueError(f"surrogate covers {self.hours[0]}-{self.hours[-1]} h, asked for {hour:g} h")
+        x = np.concatenate([[q0], initial_ys, h])[None, :]
+        u = 2 * (x - self.lower) / (self.upper - self.lower) - 1
+        phi = _features(u, self._index)[0]
+        j = min(np.searchsorted(self.hours, hour), len(self.hours) - 1)
+        ys = phi @ self.coefficients[j]
+        if self.hours[j] != hour:
+            w = (hour - self.hours[j - 1]) / (self.hours[j] - self.hours[j - 1])
+            ys = w * ys + (1 - w) * (phi @ self.coefficients[j - 1])
+        coef = _step_coefficients(h, self.Cds, self.gate_width)
+        return np.concatenate([[q0], _reported_flows(ys, coef)]), ys
+
+
+def build_surrogate(n_samples=4096, hours=range(1, 25), degree=3, Cds=[0.5] * N_GATES, gate_width=10.0, dt=10,
+                    seed=0, ridge=1e-8, chunk=256, holdout=0.1):
+    from scipy.stats import qmc  # only the offline build needs it; loading a surrogate stays cheap
+
+    hours = np.array(sorted(hours))
+    lower, upper = _design_bounds()
+    unit = qmc.Sobol(d=len(lower), scramble=True, seed=seed).random(n_samples)
+    x = qmc.scale(unit, lower, upper)
+    steps_per_hour = 3600 // dt
+    steps = int(hours[-1] * steps_per_hour)
+
+    targets = np.empty((len(hours), n_samples, N_GATES))
+    for start in range(0, n_samples, chunk):
+        block = x[start:start + chunk]
+        _, ys = simulate_gates_batch(block[:, 0], block[:, 1 + N_GATES:], initial_ys=block[:, 1:1 + N_GATES],
+                                     Cds=Cds, gate_width=gate_width, dt=dt, steps=steps)
+        targets[:, start:start + chunk] = ys[:, hours * steps_per_hour].transpose(1, 0, 2)
+
+    monomials = _monomials(len(lower), degree)
+    phi = _features(2 * unit - 1, _monomial_index(monomials, degree))
+    n_fit = n_samples - int(n_samples * holdout)
+    gram = phi[:n_fit].T @ phi[:n_fit] + ridge * n_fit * np.eye(len(monomials))
+    coefficients = np.stack([np.linalg.solve(gram, phi[:n_fit].T @ targets[k, :n_fit]) for k in range(len(hours))])
+    rmse = np.array([np.sqrt(np.mean((phi[n_fit:] @ coefficients[k] - targets[k, n_fit:]) ** 2)) for k in range(len(hours))])
+    return GateSurrogate(coefficients, hours, lower, upper, degree, Cds, gate_width, dt, rmse)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default="surrogate.npz")
+    parser.add_argument("--samples", type=int, default=4096)
+    parser.add_argument("--hours", type=int, default=24, help="fit every whole hour up to this horizon")
+    parser.add_argument("--degree", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    model = build_surrogate(args.samples, range(1, args.hours + 1), args.degree, seed=args.seed)
+    model.save(args.out)
+    print(f"Built {args.out} from {args.samples} samples in {time.perf_counter() - start:.1f} s")
+    for hour, err in zip(model.hours, model.rmse):
+        print(f"  +{hour:2d} h  held-out RMSE {err:.4f} m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Scenario sweeps over the gate simulator with columnar results.
+
+    from sweep import scenario_grid, sweep
+    scenarios = scenario_grid(q0=range(100, 141, 5), h=[[0.5] * 5, [1.0] * 5])
+    table = sweep(scenarios, steps=24 * 360, out="sweep.parquet")
+
+Scenarios are dicts with q0, h and optionally initial_ys, Cds and
+gate_width; anything missing takes the sweep's defaults. They are run in
+chunks through simulate_gates_batch (the vectorized
+simulate_gates_over_time) across a process pool, and only the per-scenario
+summary comes back: one row with the final levels and flows and the
+constraint-violation metrics over the whole horizon.
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils import simulate_gates_batch
+
+SCENARIO_KEYS = ("q0", "h", "initial_ys", "Cds", "gate_width")
+DEFAULTS = {"initial_ys": [11, 10, 9, 8, 7], "Cds": [0.6] * 5, "gate_width": 10.0}
+
+
+def scenario_grid(**axes):
+    """Cartesian product of the given axes as a list of scenario dicts.
+
+    Each axis is an iterable of values, e.g. ``q0=range(100, 141)`` or
+    ``h=itertools.product([0.5, 1.0], repeat=5)``.
+    """
+    unknown = set(axes) - set(SCENARIO_KEYS)
+    if unknown:
+        raise ValueError(f"unknown scenario keys {sorted(unknown)}, expected {SCENARIO_KEYS}")
+    names = list(axes)
+    values = [list(axes[name]) for name in names]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def _summarize_chunk(chunk, dt, steps, y_min, y_max, backend):
+    # Simulate one chunk of scenarios and reduce every trajectory to its row
+    qs, ys = simulate_gates_batch(chunk["q0"], chunk["h"], initial_ys=chunk["initial_ys"], Cds=chunk["Cds"],
+                                  gate_width=chunk["gate_width"][:, None], dt=dt, steps=steps, backend=backend)
+    levels = ys[:, 1:]
+    over = np.maximum(levels - y_max, 0).max(axis=2)
+    under = np.maximum(y_min - levels, 0).max(axis=2)
+    return {
+        "y_final": ys[:, -1],
+        "q_final": qs[:, -1],
+        "level_min": levels.min(axis=(1, 2)),
+        "level_max": levels.max(axis=(1, 2)),
+        "max_overflow": over.max(axis=1),
+        "max_underflow": under.max(axis=1),
+        "violation_time_s": ((over > 0) | (under > 0)).sum(axis=1) * dt,
+    }
+
+
+def _stack(scenarios):
+    # Scenario dicts -> one array per key, defaults filled in
+    n_gates = None
+    columns = {key: [] for key in SCENARIO_KEYS}
+    for i, scenario in enumerate(scenarios):
+        unknown = set(scenario) - set(SCENARIO_KEYS)
+        if unknown:
+            raise ValueError(f"scenario {i} has unknown keys {sorted(unknown)}")
+        if "q0" not in scenario or "h" not in scenario:
+            raise ValueError(f"scenario {i} needs q0 and h")
+        h = np.asarray(scenario["h"], dtype=float)
+        n_gates = len(h) if n_gates is None else n_gates
+        if h.shape != (n_gates,):
+            raise ValueError(f"scenario {i} has {h.shape} gate openings, expected ({n_gates},)")
+        for key in SCENARIO_KEYS:
+            value = scenario.get(key, DEFAULTS.get(key))
+            columns[key].append(np.broadcast_to(np.asarray(value, dtype=float), (n_gates,)) if key in ("initial_ys", "Cds") else value)
+    return {key: np.asarray(value, dtype=float) for key, value in columns.items()}
+
+
+def sweep_columns(scenarios, dt=10, steps=360, y_min=6, y_max=12, workers=None, chunk=64, backend="auto"):
+    """Run the scenarios and return the result columns as a dict of arrays.
+
+    workers=1 runs in-process; otherwise chunks of ``chunk`` scenarios go to
+    a process pool. Rows keep the order of ``scenarios``.
+    """
+    if steps < 1:
+        raise ValueError("steps must be at least 1")
+    inputs = _stack(scenarios)
+    n = len(inputs["q0"])
+    if n == 0:
+        raise ValueError("no scenarios to run")
+    chunks = [{key: value[start:start + chunk] for key, value in inputs.items()} for start in range(0, n, chunk)]
+    args = (dt, steps, y_min, y_max, backend)
+    if workers == 1 or len(chunks) <= 1:
+        results = [_summarize_chunk(c, *args) for c in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_summarize_chunk, chunks, *[itertools.repeat(a) for a in args]))
+
+    n_gates = inputs["h"].shape[1]
+    merged = {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+    columns = {"scenario": np.arange(n), "q0": inputs["q0"], "gate_width": inputs["gate_width"]}
+    for key, prefix in (("h", "h"), ("initial_ys", "initial_y"), ("Cds", "Cd")):
+        for i in range(n_gates):
+            columns[f"{prefix}_{i + 1}"] = inputs[key][:, i]
+    for i in range(n_gates):
+        columns[f"y_final_{i + 1}"] = merged["y_final"][:, i]
+    for i in range(n_gates + 1):
+        columns[f"q_final_{i}"] = merged["q_final"][:, i]
+    for key in ("level_min", "level_max", "max_overflow", "max_underflow", "violation_time_s"):
+        columns[key] = merged[key]
+    columns["feasible"] = columns["violation_time_s"] == 0
+    return columns
+
+
+def sweep(scenarios, dt=10, steps=360, y_min=6, y_max=12, workers=None, chunk=64, backend="auto", out=None):
+    """sweep_columns as a pyarrow Table, optionally written to ``out``.
+
+    ``out`` ending in .parquet is written as Parquet, anything else as an
+    Arrow IPC (Feather v2) file.
+    """
+    import pyarrow as pa
+
+    table = pa.table(sweep_columns(scenarios, dt, steps, y_min, y_max, workers, chunk, backend))
+    table = table.replace_schema_metadata({"dt": str(dt), "steps": str(steps), "y_min": str(y_min), "y_max": str(y_max)})
+    if out is not None:
+        if str(out).endswith(".parquet"):
+            import pyarrow.parquet as pq
+            pq.write_table(table, out)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, out)
+    return table
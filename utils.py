@@ -1,10 +1,23 @@
+import os
+import threading
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-from scipy.optimize import minimize, fsolve
+
+import kernels
+import profiling
+
+G = 9.81  # gravity
+A_RESERVOIR = 1e5  # plan area of a section used by the implicit time stepping
 
 def simulate_gates(q0, h, initial_y0=12.0, Cds=0.6, gate_width=2.0, dt=1.0):
     g = 9.81  # gravity
     A_base = 1e6
-    n_gates = 5
+    n_gates = len(h)
+    Cds = np.broadcast_to(np.asarray(Cds, dtype=float), (n_gates,))  # one Cd for every gate, or one each
     y = [initial_y0]
     q = [q0]
 
@@ -21,72 +34,423 @@ def simulate_gates(q0, h, initial_y0=12.0, Cds=0.6, gate_width=2.0, dt=1.0):
 
     return q, y
 
-def simulate_gates_over_time(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360):
-    import numpy as np
-    from scipy.optimize import fsolve
+def _step_coefficients(h, Cds, gate_width):
+    # q_out = coef * sqrt(delta_h) for every gate
+    return np.asarray(Cds, dtype=float) * np.asarray(h, dtype=float) * gate_width * np.sqrt(2 * G)
+
+def _residual_and_jacobian(y, ys_prev, q_in, coef, dt):
+    # Implicit mass balance of every section, F(y) = 0, with its analytic Jacobian.
+    # Each level only talks to its neighbours, so J is tridiagonal and symmetric:
+    # it is returned as (diag, off) bands.
+    k = dt / A_RESERVOIR
+    delta_h = y.copy()
+    delta_h[:, :-1] -= y[:, 1:]
+    active = delta_h > 0.1
+    sq = np.sqrt(np.where(active, delta_h, 0.1))
+    q_out = coef * sq
+    F = y - ys_prev + q_out * k
+    F[:, 0] -= q_in * k
+    F[:, 1:] -= q_out[:, :-1] * k
+
+    dq = np.where(active, (0.5 * k) * coef / sq, 0.0)  # k * dq_out_i/dy_i
+    diag = 1 + dq
+    diag[:, 1:] += dq[:, :-1]
+    return F, diag, -dq[:, :-1]
+
+def _solve_tridiagonal(diag, off, rhs):
+    # Batched solve of symmetric tridiagonal systems. Small batches go through
+    # one dense LAPACK call (cheaper than n Python-level sweeps), long chains
+    # with few scenarios through LAPACK's banded solver one scenario at a time,
+    # and the rest through the Thomas algorithm vectorized over the scenario axis.
+    N, n = diag.shape
+    if N * n <= 64:
+        J = np.zeros((N, n * n))
+        J[:, ::n + 1] = diag
+        J[:, 1::n + 1] = off
+        J[:, n::n + 1] = off
+        return np.linalg.solve(J.reshape(N, n, n), rhs[..., None])[..., 0]
+    if N < n:
+        from scipy.linalg import solve_banded
+        bands = np.zeros((3, n))
+        out = np.empty_like(rhs)
+        for s in range(N):
+            bands[0, 1:] = off[s]
+            bands[1] = diag[s]
+            bands[2, :-1] = off[s]
+            out[s] = solve_banded((1, 1), bands, rhs[s], check_finite=False)
+        return out
+    c = np.empty_like(off)
+    d = np.empty_like(rhs)
+    denom = diag[:, 0]
+    d[:, 0] = rhs[:, 0] / denom
+    for i in range(1, n):
+        c[:, i - 1] = off[:, i - 1] / denom
+        denom = diag[:, i] - off[:, i - 1] * c[:, i - 1]
+        d[:, i] = (rhs[:, i] - off[:, i - 1] * d[:, i - 1]) / denom
+    for i in range(n - 2, -1, -1):
+        d[:, i] -= c[:, i] * d[:, i + 1]
+    return d
+
+def _newton_step(ys_prev, q_in, coef, dt, y_guess=None, tol=1e-10, max_iter=50, metrics=None):
+    # Solve one implicit time step for all scenarios at once
+    y = (ys_prev if y_guess is None else y_guess).copy()
+    for iteration in range(1, max_iter + 1):
+        F, diag, off = _residual_and_jacobian(y, ys_prev, q_in, coef, dt)
+        delta = _solve_tridiagonal(diag, off, F)
+        y -= delta
+        if np.max(np.abs(delta)) < tol:
+            break
+    if metrics is not None:
+        metrics.add("nonlinear_solves")
+        metrics.add("residual_evaluations", iteration)
+        metrics.observe_max("max_residual_evaluations", iteration)
+    return y
+
+def _reported_flows(y, coef):
+    return coef * np.sqrt(np.maximum(y - 0.5, 0.1))
+
+def _iter_steps(coef, ys0, q0, dt, steps, ys_prev=None, inflow=None):
+    # Core implicit time loop: yields (t, ys, qs) after every step, where qs is
+    # the flow row [inflow, gate outflows...]. ys_prev (levels one step before
+    # ys0) only seeds the Newton predictor. coef may be an (N, steps, n) gate
+    # schedule, and inflow an (N, steps) series that replaces the recirculated
+    # last outflow.
+    current_ys = np.array(ys0, dtype=float)
+    current_q0 = np.array(q0, dtype=float)
+    schedule = coef
+    before = ys_prev
+    metrics = profiling.current()
+
+    for t in range(steps):
+        if schedule.ndim == 3:
+            coef = schedule[:, t]
+        if inflow is not None:
+            current_q0 = inflow[:, t]
+        # Levels move smoothly, so extrapolating the last change is a good first guess
+        guess = 2 * current_ys - before if before is not None else None
+        before = current_ys
+        if metrics is None:
+            current_ys = _newton_step(current_ys, current_q0, coef, dt, guess)
+            qs = np.concatenate([current_q0[:, None], _reported_flows(current_ys, coef)], axis=1)
+        else:
+            start = time.perf_counter()
+            current_ys = _newton_step(current_ys, current_q0, coef, dt, guess, metrics=metrics)
+            solved = time.perf_counter()
+            qs = np.concatenate([current_q0[:, None], _reported_flows(current_ys, coef)], axis=1)
+            metrics.add_time("solve", solved - start)
+            metrics.add_time("flows", time.perf_counter() - solved)
+        yield t + 1, current_ys, qs
+        current_q0 = qs[:, -1]  # optional: assume last outflow feeds next time step
+
+def _integrate_compiled(coef, ys0, q0, dt, steps, ys_prev=None, steady_tol=None, inflow=None, out=None):
+    # _integrate through the numba kernel; same outputs, one native loop
+    N, n_gates = coef.shape[0], coef.shape[-1]
+    coef = coef if coef.ndim == 3 else coef[:, None, :]
+    qs_over_time, ys_over_time = _trajectory_arrays(N, n_gates, steps, out)
+    ys0 = np.ascontiguousarray(np.broadcast_to(ys0, (N, n_gates)), dtype=float)
+    q0 = np.ascontiguousarray(np.broadcast_to(np.asarray(q0, dtype=float), (N,)))
+    prev = ys0 if ys_prev is None else np.ascontiguousarray(np.broadcast_to(ys_prev, (N, n_gates)), dtype=float)
+    metrics = profiling.current()
+    with profiling.timed("solve", metrics):
+        solves, evaluations, skipped = kernels.integrate_kernel(
+            np.ascontiguousarray(coef, dtype=float), ys0, q0,
+            np.ascontiguousarray(inflow, dtype=float) if inflow is not None else np.zeros((N, 1)), inflow is not None,
+            prev, ys_prev is not None, float(dt), int(steps),
+            A_RESERVOIR, -1.0 if steady_tol is None else float(steady_tol), 1e-10, 50, qs_over_time, ys_over_time)
+    if metrics is not None:
+        metrics.add("nonlinear_solves", solves)
+        metrics.add("residual_evaluations", evaluations)
+        if skipped:
+            metrics.add("steady_state_exits")
+            metrics.add("steps_skipped", skipped)
+    return qs_over_time, ys_over_time
+
+def _trajectory_arrays(N, n_gates, steps, out=None):
+    # Fresh (qs, ys) trajectory arrays, or the caller's out pair checked for
+    # the layout both engines write into
+    if out is None:
+        return np.empty((N, steps, n_gates + 1)), np.empty((N, steps + 1, n_gates))
+    qs, ys = out
+    for array, shape in ((qs, (N, steps, n_gates + 1)), (ys, (N, steps + 1, n_gates))):
+        if array.shape != shape or array.dtype != np.float64 or not array.flags.c_contiguous or not array.flags.writeable:
+            raise ValueError(f"out arrays must be writeable C-contiguous float64 of shape {shape}, got {array.dtype} {array.shape}")
+    return qs, ys
+
+def _integrate(coef, ys0, q0, dt, steps, ys_prev=None, steady_tol=None, backend="numpy", inflow=None, out=None):
+    # Collect the whole trajectory, as used by the batch engine and GateSimulator.
+    # With steady_tol, stop once the per-step change times the steps left is
+    # below steady_tol for every scenario and hold that state to the end
+    # (never for gate schedules or inflow series, whose inputs keep changing).
+    # out=(qs, ys) fills preallocated arrays (e.g. a chunk buffer, see
+    # archive.py) instead of allocating the trajectory.
+    if coef.ndim == 3 or inflow is not None:
+        steady_tol = None
+    if kernels.resolve_backend(backend) == "numba":
+        return _integrate_compiled(coef, ys0, q0, dt, steps, ys_prev, steady_tol, inflow, out)
+    N, n_gates = coef.shape[0], coef.shape[-1]
+    qs_over_time, ys_over_time = _trajectory_arrays(N, n_gates, steps, out)
+    ys_over_time[:, 0] = ys0
+    for t, ys, qs in _iter_steps(coef, ys0, q0, dt, steps, ys_prev, inflow):
+        qs_over_time[:, t - 1] = qs
+        ys_over_time[:, t] = ys
+        if steady_tol is not None and 1 < t < steps:
+            change = max(np.max(np.abs(ys - ys_over_time[:, t - 1])), np.max(np.abs(qs - qs_over_time[:, t - 2])))
+            if change * (steps - t) < steady_tol:
+                qs_over_time[:, t:] = qs[:, None]
+                ys_over_time[:, t + 1:] = ys[:, None]
+                metrics = profiling.current()
+                if metrics is not None:
+                    metrics.add("steady_state_exits")
+                    metrics.add("steps_skipped", steps - t)
+                break
+    return qs_over_time, ys_over_time
+
+def inflow_on_grid(q0, dt, steps, q0_times=None, start=0):
+    """Inflow series (..., m) resampled to one value per step, (..., steps).
+
+    With q0_times (m sample times in seconds) the series is interpolated
+    linearly at the end of every step and held beyond its ends; without,
+    it must already have one value per step. ``start`` resamples steps
+    start..start+steps-1 only (chunked runs, with q0_times).
+    """
+    q0 = np.asarray(q0, dtype=float)
+    if q0_times is None:
+        if q0.shape[-1] != steps:
+            raise ValueError(f"inflow series has {q0.shape[-1]} values for {steps} steps; pass q0_times")
+        return q0
+    grid = dt * np.arange(start + 1, start + steps + 1)
+    flat = q0.reshape(-1, q0.shape[-1])
+    return np.stack([np.interp(grid, q0_times, row) for row in flat]).reshape(q0.shape[:-1] + (steps,))
+
+def schedule_on_grid(h, dt, steps, h_times=None, start=0):
+    """Piecewise-constant gate schedule (..., k, n_gates) as one row per step.
+
+    Setting j applies from h_times[j] (seconds, ascending) until the next
+    one; steps starting before h_times[0] use the first setting. Without
+    h_times the schedule must already have one row per step. ``start``
+    works as in inflow_on_grid.
+    """
+    h = np.asarray(h, dtype=float)
+    if h_times is None:
+        if h.shape[-2] != steps:
+            raise ValueError(f"gate schedule has {h.shape[-2]} rows for {steps} steps; pass h_times")
+        return h
+    index = np.searchsorted(h_times, dt * np.arange(start, start + steps), side="right") - 1
+    return h[..., np.maximum(index, 0), :]
+
+def simulate_gates_batch(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360, steady_tol=None, backend="auto", q0_times=None, h_times=None):
+    """Advance N scenarios together.
+
+    h is an (N, n_gates) array of gate openings; q0, initial_ys and Cds broadcast
+    against it. Returns qs of shape (N, steps, n_gates+1) and ys of shape
+    (N, steps+1, n_gates), i.e. one simulate_gates_over_time result per row.
+    steady_tol (metres / cms) enables the early exit once the run has
+    settled: the remaining steps then repeat the settled state.
+    backend="numba" runs the compiled kernel from kernels.py, "numpy" the
+    vectorized Newton loop, "auto" the kernel whenever numba is installed.
+
+    Time-varying inputs: h may be an (N, k, n_gates) schedule (see
+    schedule_on_grid) and q0 an (N, m) inflow series (see inflow_on_grid).
+    An inflow series is the upstream inflow of every step, replacing the
+    scalar model's recirculated last outflow. Both are put on the step grid
+    once before the time loop.
+    """
+    h = np.asarray(h, dtype=float)
+    if h.ndim == 3:
+        h = schedule_on_grid(h, dt, steps, h_times)
+    else:
+        h = np.atleast_2d(h)
+    N, n_gates = h.shape[0], h.shape[-1]
+    Cds = np.broadcast_to(Cds, (N, n_gates))
+    if h.ndim == 3:
+        # per-scenario parameters broadcast over the step axis too
+        Cds = Cds[:, None]
+        gate_width = np.asarray(gate_width, dtype=float)
+        gate_width = gate_width[:, None] if gate_width.ndim == 2 else gate_width
+    coef = _step_coefficients(h, Cds, gate_width)
+    ys0 = np.broadcast_to(np.asarray(initial_ys, dtype=float), (N, n_gates))
+    q0 = np.asarray(q0, dtype=float)
+    inflow = None
+    if q0.ndim == 2:
+        inflow = np.broadcast_to(inflow_on_grid(q0, dt, steps, q0_times), (N, steps))
+        q0 = inflow[:, 0] if steps else q0[:, 0]
+    return _integrate(coef, ys0, np.broadcast_to(q0, (N,)), dt, steps, steady_tol=steady_tol, backend=backend, inflow=inflow)
+
+def simulate_gates_over_time(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360, steady_tol=None, backend="auto", q0_times=None, h_times=None):
+    # q0 may also be an inflow series and h a (k, n_gates) gate schedule,
+    # see simulate_gates_batch
+    q0 = np.asarray(q0, dtype=float)
+    qs, ys = simulate_gates_batch(q0[None] if q0.ndim else q0, [h], initial_ys=initial_ys, Cds=Cds, gate_width=gate_width, length=length, dt=dt, steps=steps, steady_tol=steady_tol, backend=backend, q0_times=q0_times, h_times=h_times)
+    return qs[0], ys[0]
+
+def equilibrium_levels(q0, h, Cds=[0.6]*5, gate_width=10.0):
+    """Steady state of the gate chain under a constant inflow q0.
+
+    At equilibrium every gate passes q0, so the heads follow in closed form
+    from the last gate upstream: (q0 / coef_i)^2, with the 0.1 m minimum head
+    the simulator uses. Returns the flow row [q0, reported outflows...] and
+    the levels, in the layout of ``qs[-1], ys[-1]``. Note that
+    simulate_gates_over_time feeds the last outflow back as the next inflow,
+    so its long runs keep draining rather than settling here; this is the
+    constant-inflow limit.
+    """
+    coef = _step_coefficients(h, Cds, gate_width)
+    heads = np.maximum((q0 / coef) ** 2, 0.1)
+    ys = np.cumsum(heads[::-1])[::-1]
+    return np.concatenate([[q0], _reported_flows(ys, coef)]), ys
+
+def simulate_gates_adaptive(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360, tol=1e-3, max_step=None):
+    """simulate_gates_over_time with adaptive step sizes.
+
+    The first dt seconds are the fixed-step model's first step (q0 feeds
+    it). After that, backward Euler steps of size H are checked against two
+    steps of H/2 (step doubling). A step is accepted when the two agree to
+    ``tol`` metres, and the Richardson-extrapolated (second order) levels
+    are kept. H grows or shrinks with the error, never below dt.
+    Levels are interpolated back onto the dt grid, so the output has the
+    same layout as simulate_gates_over_time.
+    """
+    coef = _step_coefficients(h, Cds, gate_width)[None, :]
+    n_gates = coef.shape[1]
+    y = np.asarray(initial_ys, dtype=float)[None, :]
+    horizon = steps * dt
+    times, states = [0.0], [y[0]]
+    metrics = profiling.current()
+
+    if steps:
+        y = _newton_step(y, np.array([q0], dtype=float), coef, dt, metrics=metrics)
+        times.append(dt)
+        states.append(y[0])
+    t, H = float(dt), float(dt)
+    while t < horizon - 1e-9:
+        H = min(H, horizon - t)
+        q_in = _reported_flows(y, coef)[:, -1]
+        full = _newton_step(y, q_in, coef, H, metrics=metrics)
+        half = _newton_step(y, q_in, coef, H / 2, metrics=metrics)
+        two = _newton_step(half, _reported_flows(half, coef)[:, -1], coef, H / 2, metrics=metrics)
+        err = np.max(np.abs(two - full)) / tol
+        if err <= 1 or H <= dt:
+            t += H
+            y = 2 * two - full  # Richardson extrapolation, second order
+            times.append(t)
+            states.append(y[0])
+            if metrics is not None:
+                metrics.add("adaptive_steps_accepted")
+        elif metrics is not None:
+            metrics.add("adaptive_steps_rejected")
+        # first-order method: the local error scales with H^2
+        H = max(float(dt), H * min(5.0, max(0.2, 0.9 / np.sqrt(max(err, 1e-12)))))
+        if max_step is not None:
+            H = min(H, max_step)
+
+    report_times = np.arange(steps + 1) * dt
+    times, states = np.array(times), np.array(states)
+    ys_over_time = np.column_stack([np.interp(report_times, times, states[:, i]) for i in range(n_gates)])
+    flows = _reported_flows(ys_over_time, coef)
+    qs_over_time = np.empty((steps, n_gates + 1))
+    qs_over_time[:, 1:] = flows[1:]
+    if steps:
+        qs_over_time[0, 0] = q0
+        qs_over_time[1:, 0] = flows[1:-1, -1]  # last outflow feeds the next step
+    return qs_over_time, ys_over_time
+
+SimulationStep = namedtuple("SimulationStep", ["step", "time", "ys", "qs"])
+
+def iter_gates_over_time(q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, steps=360, every=1, final_only=False):
+    """Streaming variant of simulate_gates_over_time.
+
+    Yields a SimulationStep (step index, elapsed seconds, levels, flow row)
+    every ``every`` steps, plus the last step, without keeping the history,
+    so memory stays constant whatever the horizon. ``final_only`` yields the
+    last step only, i.e. what ``qs[-1], ys[-1]`` would give.
+    """
+    coef = _step_coefficients(h, Cds, gate_width)[None, :]
+    ys0 = np.asarray(initial_ys, dtype=float)[None, :]
+    for t, ys, qs in _iter_steps(coef, ys0, [q0], dt, steps):
+        if t == steps or (not final_only and t % every == 0):
+            yield SimulationStep(t, t * dt, ys[0], qs[0])
+
+class GateSimulator:
+    """Resumable simulate_gates_over_time.
+
+    Holds a checkpoint of (current_ys, current_q0, t) and extends it with
+    advance(). A snapshot of the state is kept every ``snapshot_every`` steps
+    (one hour at dt=10), so any horizon already covered is answered from
+    history: exactly for snapshot times, otherwise by replaying at most
+    ``snapshot_every - 1`` steps from the nearest earlier snapshot.
+    """
+
+    def __init__(self, q0, h, initial_ys=[11, 10, 9, 8, 7], Cds=[0.6]*5, gate_width=10.0, length=5.0, dt=10, snapshot_every=360, backend="auto"):
+        self.h = np.asarray(h, dtype=float)
+        self.dt = dt
+        self.backend = backend
+        self.snapshot_every = snapshot_every
+        self._coef = _step_coefficients(self.h, Cds, gate_width)[None, :]
+        self.t = 0
+        self.current_ys = np.asarray(initial_ys, dtype=float).copy()
+        self.current_q0 = float(q0)
+        self.current_qs = None  # flow row of the last step taken
+        self._prev_ys = None
+        # t -> (ys, q0 feeding the next step, flow row of step t-1)
+        self.snapshots = {0: (self.current_ys.copy(), self.current_q0, None)}
+        self._lock = threading.Lock()
+
+    def advance(self, steps):
+        """Run ``steps`` more steps from the checkpoint.
+
+        Returns (qs, ys) for the new segment in simulate_gates_over_time layout,
+        ys starting at the checkpoint the segment resumed from.
+        """
+        with self._lock:
+            qs, ys = _integrate(self._coef, self.current_ys[None, :], [self.current_q0], self.dt, steps,
+                                ys_prev=None if self._prev_ys is None else self._prev_ys[None, :], backend=self.backend)
+            qs, ys = qs[0], ys[0]
+            first = -self.t % self.snapshot_every or self.snapshot_every
+            for k in range(first, steps + 1, self.snapshot_every):
+                self.snapshots[self.t + k] = (ys[k].copy(), qs[k - 1, -1], qs[k - 1].copy())
+            if steps:
+                self._prev_ys = ys[-2].copy()
+                self.current_ys = ys[-1].copy()
+                self.current_qs = qs[-1].copy()
+                self.current_q0 = qs[-1, -1]
+                self.t += steps
+            return qs, ys
+
+    def final_state(self, steps):
+        """Flow row and levels after ``steps`` steps from t=0.
+
+        Matches ``qs[-1], ys[-1]`` of simulate_gates_over_time(..., steps=steps)
+        (qs row is None for steps=0).
+        """
+        if steps > self.t:
+            self.advance(steps - self.t)
+        with self._lock:
+            if steps == self.t:
+                return self.current_qs, self.current_ys.copy()
+            if steps in self.snapshots:
+                ys, _, qs = self.snapshots[steps]
+                return qs, ys.copy()
+            start = steps - steps % self.snapshot_every
+            ys0, q0, _ = self.snapshots[start]
+        qs, ys = _integrate(self._coef, ys0[None, :], [q0], self.dt, steps - start, backend=self.backend)
+        return qs[0, -1], ys[0, -1]
 
-    g = 9.81
-    n_gates = len(h)
-    A = gate_width * length
-    A_reservoir = 1e5
-
-    ys_over_time = [initial_ys[:]]  # record water levels
-    qs_over_time = []  # record flow rates
-
-    current_ys = initial_ys[:]
-    current_q0 = q0
-
-
-    for _ in range(steps):
-        def equations(y):
-            y = np.concatenate([y, [0]])
-            eqs = []
-            q_in = current_q0
-            for i in range(n_gates):
-                Ai = h[i] * gate_width
-                delta_h = max(y[i] - y[i+1], 0.1)
-                q_out = Cds[i] * Ai * np.sqrt(2 * g * delta_h)
-                eq = y[i] - current_ys[i] - (q_in - q_out) * dt / A_reservoir
-                eqs.append(eq)
-                q_in = q_out
-            return eqs
-
-        y_sol = fsolve(equations, current_ys)
-        qs = [current_q0]
-        q_in = current_q0
-
-        for i in range(n_gates):
-            Ai = h[i] * gate_width
-            delta_h = max(y_sol[i] - 0.5, 0.1)
-            q_out = Cds[i] * Ai * np.sqrt(2 * g * delta_h)
-            qs.append(q_out)
-            q_in = q_out
-
-        # Update state
-        current_ys = list(y_sol)
-        current_q0 = qs[-1]  # optional: assume last outflow feeds next time step
-
-        ys_over_time.append(current_ys[:])
-        qs_over_time.append(qs[:])
-
-    return np.array(qs_over_time), np.array(ys_over_time)
-    
 def objective(h, q0=100):
     _, y = simulate_gates(q0, h)
     mean_y = np.mean(y)
     return sum((yi - mean_y) ** 2 for yi in y)  # variance
 
-def optimize_gate_openings(q0=100):
-    bounds = [(0.1, 2)] * 5  # h1 to h4 between 0% and 100%
-    initial_guess = [0.5] * 5
+def optimize_gate_openings(q0=100, n_gates=5):
+    bounds = [(0.1, 2)] * n_gates  # every opening between 0.1 m and 2 m
+    initial_guess = [0.5] * n_gates
+    from scipy.optimize import minimize
     result = minimize(objective, initial_guess, args=(q0,), bounds=bounds)
     return result.x, result.fun
 
-def hybrid_loss_fn(h, q0, initial_y0, q_target, y_target=None, initial_ys=[10, 8, 7, 6], y_min=6, y_max=12, Cds=None, dt=10, steps=360, penalty_weight=100):
-    # print(q0, h, initial_ys, Cds, dt, steps)
-    q, y = simulate_gates_over_time(q0, h, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps)
-    q = q[-1,1:]
-    y = y[-1,1:]
+def _hybrid_loss(q, y, q_target, y_target=None, y_min=6, y_max=12, penalty_weight=100):
+    # Loss on a final state: q is the flow row, y the levels
+    q = q[1:]
+    y = y[1:]
 
     if y_target is not None:
         # 🎯 Match specific y targets
@@ -102,6 +466,157 @@ def hybrid_loss_fn(h, q0, initial_y0, q_target, y_target=None, initial_ys=[10, 8
 
     return loss
 
+def hybrid_loss_fn(h, q0, initial_y0, q_target, y_target=None, initial_ys=[10, 8, 7, 6], y_min=6, y_max=12, Cds=None, dt=10, steps=360, penalty_weight=100):
+    # print(q0, h, initial_ys, Cds, dt, steps)
+    metrics = profiling.current()
+    if metrics is not None:
+        metrics.add("loss_evaluations")
+    q, y = simulate_gates_over_time(q0, h, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps)
+    return _hybrid_loss(q[-1], y[-1], q_target, y_target, y_min, y_max, penalty_weight)
+
+def _adjoint_gradient(h, qs, ys, coef, dt, gy_final, backend="auto"):
+    # Backward pass through the implicit steps of one trajectory. gy_final is
+    # dL/dy at the last step; returns dL/dh through the time stepping.
+    k = dt / A_RESERVOIR
+    steps, n = qs.shape[0], ys.shape[1]
+    grad = np.zeros(n)
+    if steps == 0:
+        return grad
+    if kernels.resolve_backend(backend) == "numba":
+        kernels.adjoint_kernel(np.ascontiguousarray(h, dtype=float), np.ascontiguousarray(coef[0]), np.ascontiguousarray(qs), np.ascontiguousarray(ys),
+                               float(dt), A_RESERVOIR, np.array(gy_final, dtype=float), grad)
+        return grad
+
+    # Jacobians of every step at the converged levels, factorized in one go
+    _, diag, off = _residual_and_jacobian(ys[1:], ys[:-1], qs[:, 0], coef, dt)
+    c = np.empty_like(off)
+    denom = np.empty_like(diag)
+    denom[:, 0] = diag[:, 0]
+    for i in range(1, n):
+        c[:, i - 1] = off[:, i - 1] / denom[:, i - 1]
+        denom[:, i] = diag[:, i] - off[:, i - 1] * c[:, i - 1]
+
+    # d(next inflow)/dy_last, with next inflow = reported outflow of the last gate
+    y_last = ys[1:, -1]
+    r_active = y_last - 0.5 > 0.1
+    r_y = np.where(r_active, 0.5 * coef[0, -1] / np.sqrt(np.maximum(y_last - 0.5, 0.1)), 0.0)
+    r_h = qs[:, -1] / h[-1]
+
+    c, denom, off, r_y = c.tolist(), denom.tolist(), off.tolist(), r_y.tolist()
+    mus = np.empty((steps, n))
+    lam_y = list(gy_final)
+    lam_u = 0.0
+    grad_u = 0.0
+    for t in range(steps - 1, -1, -1):
+        # J is symmetric, so J^T mu = a is the same tridiagonal solve
+        a = lam_y
+        a[-1] += lam_u * r_y[t]
+        grad_u += lam_u * r_h[t]
+        ct, dt_, ot = c[t], denom[t], off[t]
+        mu = [0.0] * n
+        mu[0] = a[0] / dt_[0]
+        for i in range(1, n):
+            mu[i] = (a[i] - ot[i - 1] * mu[i - 1]) / dt_[i]
+        for i in range(n - 2, -1, -1):
+            mu[i] -= ct[i] * mu[i + 1]
+        mus[t] = mu
+        lam_y = mu
+        lam_u = k * mu[0]
+
+    # dF_i/dh_i = k q_out_i / h_i and dF_{i+1}/dh_i = -k q_out_i / h_i
+    delta_h = ys[1:].copy()
+    delta_h[:, :-1] -= ys[1:, 1:]
+    q_out = coef * np.sqrt(np.maximum(delta_h, 0.1))
+    mu_diff = mus.copy()
+    mu_diff[:, :-1] -= mus[:, 1:]
+    grad -= k * np.sum(q_out * mu_diff, axis=0) / h
+    grad[-1] += grad_u
+    return grad
+
+def hybrid_loss_and_grad(h, q0, initial_y0, q_target, y_target=None, initial_ys=[10, 8, 7, 6], y_min=6, y_max=12, Cds=None, dt=10, steps=360, penalty_weight=100):
+    """hybrid_loss_fn together with its exact gradient w.r.t. the gate openings.
+
+    The gradient comes from one forward simulation plus one adjoint pass
+    backwards through the implicit time steps.
+    """
+    metrics = profiling.current()
+    if metrics is not None:
+        metrics.add("loss_evaluations")
+        metrics.add("gradient_evaluations")
+    h = np.asarray(h, dtype=float)
+    coef = _step_coefficients(h, Cds, gate_width=10.0)[None, :]
+    qs, ys = simulate_gates_over_time(q0, h, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps)
+    y_final = ys[-1]
+    y = y_final[1:]
+    n = len(h)
+
+    gy = np.zeros(n)
+    grad_h = np.zeros(n)
+    if y_target is not None:
+        # 🎯 Match specific y targets
+        m = min(len(y), len(y_target))
+        err = y[:m] - np.asarray(y_target, dtype=float)[:m]
+        loss = np.sum(err ** 2)
+        gy[1:1 + m] = 2 * err
+    else:
+        # 🛟 Keep y within safe bounds and match q_target
+        under = np.minimum(y - y_min, 0)
+        over = np.maximum(y - y_max, 0)
+        penalties = np.sum(under ** 2 + over ** 2)
+        q_last = _reported_flows(y_final, coef[0])[-1]
+        q_loss = (q_last - q_target) ** 2
+        loss = q_loss + penalty_weight * penalties
+        gy[1:] = penalty_weight * 2 * (under + over)
+        dq = 2 * (q_last - q_target)
+        if y_final[-1] - 0.5 > 0.1:
+            gy[-1] += dq * 0.5 * coef[0, -1] / np.sqrt(y_final[-1] - 0.5)
+        grad_h[-1] += dq * q_last / h[-1]
+
+    with profiling.timed("adjoint", metrics):
+        grad_h += _adjoint_gradient(h, qs, ys, coef, dt, gy)
+    return loss, grad_h
+
+def surrogate_loss_fn(h, surrogate, q0, initial_y0, q_target, y_target=None, initial_ys=[10, 8, 7, 6], y_min=6, y_max=12, Cds=None, dt=10, steps=360, penalty_weight=100):
+    # hybrid_loss_fn on a GateSurrogate's prediction instead of a simulation
+    q, y = surrogate.predict(q0, initial_ys, h, steps)
+    return _hybrid_loss(q, y, q_target, y_target, y_min, y_max, penalty_weight)
+
+def _minimize_hybrid(initial_guess, args, jac="adjoint", maxiter=None, callback=None):
+    # One local L-BFGS-B run on the hybrid loss.
+    # jac="adjoint" uses the exact gradient from hybrid_loss_and_grad,
+    # jac=None falls back to finite differences on hybrid_loss_fn.
+    # callback(intermediate_result) sees every iterate, as in scipy.
+    from scipy.optimize import minimize  # SciPy loads on the first optimization, not at import
+
+    bounds = [(0.1, 2)] * len(initial_guess)
+    options = None if maxiter is None else {"maxiter": maxiter}
+    if jac == "adjoint":
+        return minimize(hybrid_loss_and_grad, initial_guess, args=args, jac=True, bounds=bounds, options=options, callback=callback)
+    return minimize(hybrid_loss_fn, initial_guess, args=args, bounds=bounds, options=options, callback=callback)
+
+def _load_surrogate(surrogate):
+    # Accept a GateSurrogate or the path of one saved by surrogate.py; a
+    # rebuilt file (new mtime) is loaded again
+    if not isinstance(surrogate, str):
+        return surrogate
+    from surrogate import GateSurrogate
+    key = (surrogate, os.stat(surrogate).st_mtime_ns)
+    with _surrogate_lock:
+        if key not in _surrogates:
+            _surrogates[key] = GateSurrogate.load(surrogate)
+        return _surrogates[key]
+
+_surrogates = {}
+_surrogate_lock = threading.Lock()
+
+def _warm_start(initial_guess, previous, n_gates):
+    # Starting openings: explicit guess, else the previous optimum, else cold
+    if initial_guess is None and previous is not None:
+        initial_guess = previous.x if hasattr(previous, "x") else previous[0]
+    if initial_guess is None:
+        return [0.5] * n_gates
+    return np.clip(np.asarray(initial_guess, dtype=float), 0.1, 2)
+
 def smart_optimize_gates(
     q0=100, 
     initial_y0=12.0,
@@ -112,14 +627,102 @@ def smart_optimize_gates(
     y_max=12, 
     Cds=[0.6]*5,
     dt=10,
-    steps=360
+    steps=360,
+    jac="adjoint",
+    surrogate=None,
+    polish_iter=None,
+    initial_guess=None,
+    previous=None,
+    callback=None
+):
+    # surrogate (a GateSurrogate or the path of one) searches on the response
+    # surface first, then polishes on the true simulator from that point, to
+    # convergence unless polish_iter caps the iterations.
+    # initial_guess / previous (an earlier return value or OptimizeResult)
+    # warm-start the search instead of the cold [0.5]*5. callback is passed
+    # to scipy's minimize (only the true-simulation iterations report to it)
+    initial_guess = _warm_start(initial_guess, previous, len(Cds))
+    args = (q0, initial_y0, q_target, y_target, initial_ys, y_min, y_max, Cds, dt, steps)
+    metrics = profiling.current()
+    with profiling.timed("optimize", metrics):
+        if surrogate is not None:
+            surrogate = _load_surrogate(surrogate)
+            surrogate.check(Cds, dt)
+            from scipy.optimize import minimize
+            with profiling.timed("surrogate", metrics):
+                coarse = minimize(surrogate_loss_fn, initial_guess, args=(surrogate,) + args, bounds=[(0.1, 2)] * len(initial_guess))
+            initial_guess = coarse.x
+            result = _minimize_hybrid(initial_guess, args, jac, maxiter=polish_iter, callback=callback)
+        else:
+            result = _minimize_hybrid(initial_guess, args, jac, callback=callback)
+    if metrics is not None:
+        metrics.add("optimizer_iterations", result.nit)
+    return result.x, result.fun, simulate_gates_over_time(q0, result.x, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps)
+
+def _start_points(n_starts, n_gates, sampler="lhs", seed=None, bounds=(0.1, 2)):
+    # Space-filling starting points inside the gate bounds; the first one is
+    # always the classic [0.5]*n start so multi-start never does worse than it
+    from scipy.stats import qmc  # scipy.stats is slow to import and only multi-start needs it
+
+    if sampler == "sobol":
+        engine = qmc.Sobol(d=n_gates, scramble=True, seed=seed)
+    else:
+        engine = qmc.LatinHypercube(d=n_gates, seed=seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # Sobol warns when n is not a power of 2
+        unit = engine.random(max(n_starts - 1, 0))
+    points = qmc.scale(unit, *bounds) if len(unit) else unit.reshape(0, n_gates)
+    return np.vstack([np.full((1, n_gates), 0.5), points])
+
+def _multi_start_worker(x0, args, jac):
+    result = _minimize_hybrid(x0, args, jac)
+    return {"x0": np.asarray(x0), "x": result.x, "fun": float(result.fun), "nfev": result.nfev}
+
+def multi_start_optimize_gates(
+    q0=100,
+    initial_y0=12.0,
+    q_target=80,
+    initial_ys=[10,8,7,6],
+    y_target=None,
+    y_min=6,
+    y_max=12,
+    Cds=[0.6]*5,
+    dt=10,
+    steps=360,
+    jac="adjoint",
+    n_starts=8,
+    workers=None,
+    sampler="lhs",
+    seed=0,
+    target_loss=None
 ):
-    bounds = [(0.1, 2)] * 5
-    initial_guess = [0.5] * 5
-    result = minimize(
-        hybrid_loss_fn,
-        initial_guess,
-        args=(q0, initial_y0, q_target, y_target, initial_ys, y_min, y_max, Cds, dt, steps),
-        bounds=bounds
-    )
-    return result.x, result.fun, simulate_gates_over_time(q0, result.x, initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps)
\ No newline at end of file
+    """smart_optimize_gates from several starting points in a process pool.
+
+    Starts are a Latin hypercube (or scrambled Sobol) design over the gate
+    bounds. As soon as one start reaches ``target_loss`` the starts that have
+    not begun are cancelled. Returns the best (h, loss, simulation) like
+    smart_optimize_gates, plus every finished candidate sorted by loss.
+    """
+    args = (q0, initial_y0, q_target, y_target, initial_ys, y_min, y_max, Cds, dt, steps)
+    starts = _start_points(n_starts, len(Cds), sampler=sampler, seed=seed)
+    candidates = []
+
+    if workers == 1:
+        for x0 in starts:
+            candidates.append(_multi_start_worker(x0, args, jac))
+            if target_loss is not None and candidates[-1]["fun"] <= target_loss:
+                break
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [executor.submit(_multi_start_worker, x0, args, jac) for x0 in starts]
+            for future in as_completed(futures):
+                candidates.append(future.result())
+                if target_loss is not None and candidates[-1]["fun"] <= target_loss:
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    candidates.sort(key=lambda c: c["fun"])
+    best = candidates[0]
+    return best["x"], best["fun"], simulate_gates_over_time(q0, best["x"], initial_ys=initial_ys, Cds=Cds, dt=dt, steps=steps), candidates